@@ -0,0 +1,157 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Headless batch runner for experiment specs, sharded across machines
+# Usage: python batch.py run spec.json --shard 0/4 --output results/
+#        python batch.py merge spec.json results/ --output sweep.pkl
+# Spec: {"config": {"TAX_RATE": .1, "HOOD_FORMATION": "STATIC"},
+#        "grid": {"SKILL_FROM_INCOME": [.01, .02], "CAPITAL_EFFICIENCY": [.5, 1]},
+#        "trials": 8, "seed": 12345, "batched": true, "mobility": true}
+
+from sim import Sim
+from config import Config, Globals
+from results import SimResultAgg, SimResultSweep
+from design import full_factorial, latin_hypercube
+from recorder import RecorderGroup, SummaryRecorder
+from mobility import MobilityRecorder
+from numpy.random import SeedSequence, default_rng
+from enum import Enum
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+
+
+def load_spec(path: str) -> dict:
+    if path.endswith('.toml'):
+        # stdlib from python 3.11, only needed for toml specs
+        import tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def spec_hash(spec: dict) -> str:
+    """ shards only merge with shards of the same spec """
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def grid_points(spec: dict) -> list:
+    """ full factorial of the grid, in the order its parameters are listed, crossed
+        with a latin hypercube when the spec has one:
+        "latin_hypercube": {"points": 20, "bounds": {"TAX_RATE": [0, .2]}} """
+    points = full_factorial(spec.get('grid', {}))
+    if 'latin_hypercube' in spec:
+        design = spec['latin_hypercube']
+        sample = latin_hypercube(design['bounds'], design['points'], spec.get('seed', 12345))
+        points = [{**point, **sampled} for point in points for sampled in sample]
+    return points
+
+
+def shard_points(npoints: int, shard: int, nshards: int) -> list:
+    """ dealt round robin so every shard gets a mix of the grid """
+    return list(range(shard, npoints, nshards))
+
+
+def _value(param: str, value):
+    """ enums are named in specs """
+    default = getattr(Config(), param, None)
+    if isinstance(default, Enum) and not isinstance(value, Enum):
+        return type(default)[value]
+    return value
+
+
+def make_config(spec: dict, point: dict) -> Config:
+    config = Config()
+    for param, value in {**spec.get('config', {}), **point}.items():
+        config.set(param, _value(param, value))
+    return config
+
+
+def run_point(spec: dict, point: dict, seed: SeedSequence) -> SimResultAgg:
+    sim = Sim()
+    sim.config = make_config(spec, point)
+    # the noise bank is keyed by the spec's seed, the stream by the point
+    sim.globals = Globals(spec.get('seed', 12345))
+    sim.globals.rng = default_rng(seed)
+    recorder = RecorderGroup(SummaryRecorder(), MobilityRecorder()) if spec.get('mobility', False) else None
+    return sim.run(spec.get('trials', 1), batched=spec.get('batched', True), recorder=recorder)
+
+
+def shard_file(output: str, shard: int, nshards: int) -> str:
+    return os.path.join(output, f'shard_{shard}_of_{nshards}.npz')
+
+
+def run_shard(spec: dict, shard: int, nshards: int, output: str) -> str:
+    """ runs this shard's points and writes their summaries to one compressed file """
+    points = grid_points(spec)
+    # each point gets the same seed whichever shard runs it
+    seeds = SeedSequence(spec.get('seed', 12345)).spawn(len(points))
+    arrays = {}
+    for i in shard_points(len(points), shard, nshards):
+        print(f'point {i}: {points[i]}')
+        for name, array in run_point(spec, points[i], seeds[i]).to_arrays().items():
+            arrays[f'{i}/{name}'] = array
+    meta = {'spec': spec_hash(spec), 'shard': shard, 'nshards': nshards,
+            'points': shard_points(len(points), shard, nshards)}
+    os.makedirs(output, exist_ok=True)
+    path = shard_file(output, shard, nshards)
+    np.savez_compressed(path, meta=np.array(json.dumps(meta)), **arrays)
+    return path
+
+
+def merge(spec: dict, paths: list) -> SimResultSweep:
+    """ rebuilds the sweep from shard files. params are tuples in grid order,
+        or plain values for a one parameter grid """
+    points = grid_points(spec)
+    results = {}
+    for path in paths:
+        with np.load(path) as shard:
+            meta = json.loads(str(shard['meta']))
+            if meta['spec'] != spec_hash(spec):
+                print(f'Error: {path} was run from a different spec, skipping it')
+                continue
+            for i in meta['points']:
+                results[i] = {name.split('/', 1)[1]: shard[name] for name in shard.files if name.startswith(f'{i}/')}
+    missing = [i for i in range(len(points)) if i not in results]
+    if missing:
+        print(f'Error: {len(missing)} of {len(points)} points have no results, e.g. {points[missing[0]]}')
+    sweep = SimResultSweep()
+    for i in sorted(results):
+        values = tuple(points[i].values())
+        agg = SimResultAgg.from_arrays(results[i], make_config(spec, points[i]).GINI_BINS)
+        sweep.add(agg, values[0] if len(values) == 1 else values)
+    return sweep
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless batch runner for experiment specs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run one shard of the grid')
+    run.add_argument('spec', help='JSON or TOML experiment spec')
+    run.add_argument('--shard', default='0/1', help='i/k runs the i-th of k shards')
+    run.add_argument('--output', default='results', help='directory for shard files')
+    combine = commands.add_parser('merge', help='merge shard files into a SimResultSweep')
+    combine.add_argument('spec')
+    combine.add_argument('shards', help='directory holding the shard files')
+    combine.add_argument('--output', default='sweep.pkl', help='where to pickle the merged sweep')
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    if args.command == 'run':
+        shard, nshards = (int(part) for part in args.shard.split('/'))
+        if not 0 <= shard < nshards:
+            parser.error(f'--shard {args.shard} is out of range')
+        print(f'wrote {run_shard(spec, shard, nshards, args.output)}')
+    else:
+        paths = sorted(os.path.join(args.shards, name) for name in os.listdir(args.shards)
+                       if name.startswith('shard_') and name.endswith('.npz'))
+        sweep = merge(spec, paths)
+        with open(args.output, 'wb') as f:
+            pickle.dump(sweep, f)
+        print(f'merged {len(paths)} shards, {len(sweep.income.params)} points into {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Scaling benchmarks for the simulation engine
+# Usage: python benchmark.py --grid quick --output bench.json --baseline baseline.json
+#        python benchmark.py --grid full --max-bytes 8e9
+
+from sim import Sim
+from config import HoodFormation
+from profiler import Profiler
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+import numpy as np
+
+# a parameter set that stays finite for every formation
+STABLE = {
+    'INCOME_GROWTH': 1,
+    'TAX_RATE': .1,
+    'SKILL_FROM_INCOME': .01,
+    'CAPITAL_EFFICIENCY': .5,
+    'INCOME_NOISE_ADDITIVE': .3,
+}
+
+GRIDS = {
+    'quick': {
+        'N_FAMILIES': [50, 1000],
+        'N_TIMESTEPS': [50],
+        'ntrials': [1, 20],
+        'HOOD_FORMATION': list(HoodFormation),
+    },
+    'full': {
+        'N_FAMILIES': [50, 1000, 10000, 100000],
+        'N_TIMESTEPS': [100, 1000],
+        'ntrials': [1, 100, 1000],
+        'HOOD_FORMATION': list(HoodFormation),
+    },
+}
+
+def state_bytes(case: dict) -> int:
+    """ estimated size of a batched run's state: income, noise and capital floats
+        plus hood and pop ints for every timestep, trial and family """
+    itemsize = np.dtype(Sim().config.FLOAT_DTYPE).itemsize
+    return case['N_TIMESTEPS'] * case['ntrials'] * case['N_FAMILIES'] * (3 * itemsize + 2 * 4)
+
+
+def write_report(path: str, report: dict):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def make_sim(case: dict) -> Sim:
+    sim = Sim()
+    for param, value in STABLE.items():
+        sim.set(param, value)
+    sim.set('N_FAMILIES', case['N_FAMILIES'])
+    sim.set('N_TIMESTEPS', case['N_TIMESTEPS'])
+    sim.set('HOOD_FORMATION', HoodFormation[case['HOOD_FORMATION']])
+    return sim
+
+
+def measure(fn, repeat: int) -> dict:
+    """ best wall time of `repeat` calls, and the peak traced allocation of one """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def time_phases(case: dict) -> dict:
+    """ cumulative seconds in each phase over one batched run """
+    sim = make_sim(case)
+    sim.profiler = Profiler()
+    sim.run(case['ntrials'], batched=True)
+    return {phase: stats.seconds for phase, stats in sim.profiler.stats.items()}
+
+
+def run_case(case: dict, repeat: int) -> dict:
+    row = dict(case)
+    row['run'] = measure(lambda: make_sim(case).run(case['ntrials']), repeat)
+    row['run_batched'] = measure(lambda: make_sim(case).run(case['ntrials'], batched=True), repeat)
+    row['run_sweep'] = measure(lambda: make_sim(case).run_sweep('TAX_RATE', [.05, .1], case['ntrials'], batched=True),
+                               repeat)
+    row['phases'] = time_phases(case)
+    return row
+
+
+def measure_startup(repeat: int) -> dict:
+    """ fresh interpreter importing the sim and running one small trial, which should
+        not pull in pandas or seaborn """
+    script = ("import time; start = time.perf_counter(); import sim; imported = time.perf_counter(); "
+              "sim.Sim().run(); import sys, json; "
+              "print(json.dumps([imported - start, time.perf_counter() - start, 'pandas' in sys.modules]))")
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = [json.loads(subprocess.run([sys.executable, '-c', script], cwd=here, capture_output=True,
+                                      text=True, check=True).stdout) for _ in range(repeat)]
+    return {'import_seconds': min(r[0] for r in runs), 'seconds': min(r[1] for r in runs),
+            'loads_pandas': any(r[2] for r in runs)}
+
+
+def case_key(row: dict) -> tuple:
+    return (row['N_FAMILIES'], row['N_TIMESTEPS'], row['ntrials'], row['HOOD_FORMATION'])
+
+
+def compare(rows: list, baseline: list, tolerance: float) -> list:
+    """ one verdict per timing that the baseline also measured """
+    previous = {case_key(row): row for row in baseline}
+    verdicts = []
+    for row in rows:
+        old = previous.get(case_key(row))
+        if old is None:
+            continue
+        for kind in ['run', 'run_batched', 'run_sweep']:
+            ratio = row[kind]['seconds'] / old[kind]['seconds']
+            if ratio > 1 + tolerance:
+                verdict = 'slower'
+            elif ratio < 1 - tolerance:
+                verdict = 'faster'
+            else:
+                verdict = 'same'
+            verdicts.append({'case': case_key(row), 'kind': kind, 'ratio': ratio, 'verdict': verdict,
+                             'memory_ratio': row[kind]['peak_bytes'] / max(1, old[kind]['peak_bytes'])})
+    return verdicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmarks for the simulation engine')
+    parser.add_argument('--grid', choices=GRIDS.keys(), default='quick')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench.json', help='where to write machine readable results')
+    parser.add_argument('--baseline', help='earlier --output to compare against')
+    parser.add_argument('--tolerance', type=float, default=.1, help='relative change that counts as a regression')
+    parser.add_argument('--max-bytes', type=float, default=2**32,
+                        help='skip cases whose state would take more memory than this')
+    args = parser.parse_args()
+
+    grid = GRIDS[args.grid]
+    rows = []
+    report = {'machine': platform.platform(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'grid': args.grid, 'results': rows, 'skipped': []}
+    for values in itertools.product(*grid.values()):
+        case = dict(zip(grid.keys(), values))
+        case['HOOD_FORMATION'] = case['HOOD_FORMATION'].name
+        if state_bytes(case) > args.max_bytes:
+            print(f"{case_key(case)}: skipped, needs about {state_bytes(case) / 2**30:.2f} GiB")
+            report['skipped'].append(case)
+            continue
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            row = run_case(case, args.repeat)
+        rows.append(row)
+        print(f"{case_key(row)}: run {row['run']['seconds']:.3f}s, batched {row['run_batched']['seconds']:.3f}s, "
+              f"sweep {row['run_sweep']['seconds']:.3f}s, peak {row['run']['peak_bytes'] / 2**20:.1f} MiB")
+        # written as it goes so a long grid that is cut short keeps what it finished
+        write_report(args.output, report)
+
+    startup = measure_startup(args.repeat)
+    print(f"startup: import {1e3 * startup['import_seconds']:.0f} ms, small run {1e3 * startup['seconds']:.0f} ms"
+          f"{', loads pandas!' if startup['loads_pandas'] else ''}")
+
+    report['startup'] = startup
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        verdicts = compare(rows, baseline['results'], args.tolerance)
+        if 'startup' in baseline:
+            ratio = startup['seconds'] / baseline['startup']['seconds']
+            print(f"startup: x{ratio:.2f} time")
+        report['verdicts'] = verdicts
+        for v in verdicts:
+            print(f"{v['case']} {v['kind']}: {v['verdict']} (x{v['ratio']:.2f} time, x{v['memory_ratio']:.2f} memory)")
+    write_report(args.output, report)
+
+
+if __name__ == '__main__':
+    main()
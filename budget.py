@@ -0,0 +1,55 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Adaptive trial counts that stop once the outputs are precise enough
+
+from results import SimResultAgg, RunningMoments
+from statistics import NormalDist
+import numpy as np
+from numpy import ndarray
+
+
+class TrialBudget():
+    """ Runs trials in batches until the confidence interval of every output is
+        narrow enough, or max_trials is reached. An output is a (result, stat) pair,
+        e.g. ("income", "gini"), taken at timestep `at` of each trial. With relative
+        tolerance the half-width is compared to tolerance * |mean|. """
+    OUTPUTS = [("income", "mean"), ("income", "gini"), ("human_capital", "mean")]
+
+    def __init__(self, tolerance=.01, relative=True, confidence=.95, batch=8, min_trials=16,
+                 max_trials=512, outputs: list = None, at=-1):
+        self.tolerance = tolerance
+        self.relative = relative
+        # normal rather than student t quantile, min_trials keeps the difference small
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.batch = batch
+        self.min_trials = min_trials
+        self.max_trials = max_trials
+        self.outputs = outputs or TrialBudget.OUTPUTS
+        self.at = at
+
+    def start(self) -> RunningMoments:
+        return RunningMoments(len(self.outputs))
+
+    def next_batch(self, ntrials: int) -> int:
+        return min(self.batch, self.max_trials - ntrials)
+
+    def values(self, result: SimResultAgg, first_trial: int) -> ndarray:
+        """ outputs of trials first_trial onwards, ordered output x trial """
+        values = []
+        for name, stat in self.outputs:
+            data = getattr(result, name)
+            summary = data.columns[self.at].reshape(data.ntrials, len(data.stats))
+            values.append(summary[first_trial:, data.stats.index(stat)])
+        return np.array(values)
+
+    def half_width(self, moments: RunningMoments) -> ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.z * moments.std() / np.sqrt(moments.count)
+
+    def done(self, moments: RunningMoments, ntrials: int) -> bool:
+        if ntrials >= self.max_trials:
+            return True
+        if ntrials < self.min_trials:
+            return False
+        target = self.tolerance * np.abs(moments.mean) if self.relative else self.tolerance
+        # NaN widths, e.g. every trial diverged, never count as done
+        return bool((self.half_width(moments) <= target).all())
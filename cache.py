@@ -0,0 +1,82 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Persistent cache of aggregated results keyed by config, seed and trials
+
+from config import Config
+from results import SimResultAgg
+import numpy as np
+import hashlib
+import json
+import os
+import time
+
+
+def canonical_hash(config: Config, *extra) -> str:
+    """ sha256 of the config's fields plus anything else that decides the result.
+        numbers are compared as floats so 1 and 1.0 hash alike """
+    fields = {k: float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else v
+              for k, v in config.describe().items()}
+    text = json.dumps([fields, *extra], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache():
+    """ A directory of .npz summaries, one per (config, seed, ntrials, batched,
+        recorder), and an index.json of their sizes and last use. Once the files
+        outgrow max_bytes the least recently used ones are dropped. """
+    def __init__(self, path: str, max_bytes=2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.index_file = os.path.join(path, "index.json")
+        self.entries = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.entries = json.load(f)["entries"]
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.npz")
+
+    def _flush(self):
+        with open(self.index_file, "w") as f:
+            json.dump({"entries": self.entries}, f)
+
+    def key(self, config: Config, seed: int, ntrials: int, batched: bool, recorder: str = None) -> str:
+        """ recorder names the recorder that filled in extra summaries, if any """
+        return canonical_hash(config, seed, ntrials, batched, *([recorder] if recorder else []))
+
+    def get(self, config: Config, seed: int, ntrials: int, batched: bool, recorder: str = None) -> SimResultAgg:
+        """ the cached result, or None """
+        key = self.key(config, seed, ntrials, batched, recorder)
+        if key not in self.entries or not os.path.exists(self._file(key)):
+            return None
+        with np.load(self._file(key)) as arrays:
+            result = SimResultAgg.from_arrays(dict(arrays), config.GINI_BINS)
+        self.entries[key]["used"] = time.time()
+        self._flush()
+        return result
+
+    def put(self, config: Config, seed: int, ntrials: int, batched: bool, result: SimResultAgg,
+            recorder: str = None):
+        key = self.key(config, seed, ntrials, batched, recorder)
+        np.savez_compressed(self._file(key), **result.to_arrays())
+        self.entries[key] = {"bytes": os.path.getsize(self._file(key)), "used": time.time()}
+        self._evict()
+        self._flush()
+
+    def size(self) -> int:
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def _evict(self):
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["used"]):
+            if self.size() <= self.max_bytes:
+                break
+            if os.path.exists(self._file(key)):
+                os.remove(self._file(key))
+            del self.entries[key]
+
+    def clear(self):
+        for key in self.entries:
+            if os.path.exists(self._file(key)):
+                os.remove(self._file(key))
+        self.entries = {}
+        self._flush()
@@ -0,0 +1,45 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Snapshots of a running simulation that can be restored or forked
+
+from config import Config
+import numpy as np
+import pickle
+import copy
+
+
+class Checkpoint():
+    """ Everything a batch needs to carry on from timestep t: the mechanism state
+        arrays, the MA(1) income noise, early stopping, the rng's bit generator and
+        the seed that keys the common noise bank.
+        Restoring one and stepping on gives the same result as never stopping. """
+    def __init__(self, config: Config, t: int, ntrials: int, window: int, states: dict,
+                 status: np.ndarray, stop_step: np.ndarray, rng_state: dict, first_trial=0, seed=12345):
+        self.config = config
+        self.t = t
+        self.ntrials = ntrials
+        self.window = window
+        self.first_trial = first_trial
+        self.states = states # income, noise, capital, hood and pop
+        self.status = status
+        self.stop_step = stop_step
+        self.rng_state = rng_state
+        self.seed = seed
+
+    @classmethod
+    def capture(cls, sim) -> 'Checkpoint':
+        states = {"income": sim.income.income, "noise": sim.income.noise, "capital": sim.capital.capital,
+                  "hood": sim.neighborhood.hood, "pop": sim.neighborhood.pop}
+        return Checkpoint(copy.copy(sim.config), sim.globals.t, sim.globals.ntrials, sim.globals.window,
+                          {name: state.copy() for name, state in states.items()},
+                          sim.stopping.status.copy(), sim.stopping.stop_step.copy(),
+                          copy.deepcopy(sim.globals.rng.bit_generator.state), sim.globals.first_trial,
+                          sim.globals.seed)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'Checkpoint':
+        with open(path, "rb") as f:
+            return pickle.load(f)
@@ -12,6 +12,13 @@ class HoodFormation(Enum):
     PERFECT_SORTING = auto()
 
 
+class TrialStatus(Enum):
+    COMPLETED = auto()
+    NONFINITE = auto() # overflow or NaN
+    EXPLOSIVE = auto() # grew past DIVERGENCE_LIMIT or GROWTH_LIMIT
+    CONVERGED = auto() # relative change fell below CONVERGENCE_TOL
+
+
 class Config():
     def __init__(self):
         self.N_FAMILIES = 50
@@ -31,6 +38,13 @@ class Config():
         self.UTILITY_CHILD_INCOME = (1 - self.UTILITY_CONSUMPTION)
         self.EDU_EFFICIENCY_UPPER = .9 # lambda
         self.EDU_EFFICIENCY_LOWER = .1 # lambda
+        self.FLOAT_DTYPE = 'float64' # or 'float32' to halve memory traffic on big populations
+        self.GINI_BINS = 0 # 0 sorts for the exact gini, else bins for the O(N) estimate
+        self.EARLY_STOP = False # stop trials that blow up or reach a fixed point
+        self.DIVERGENCE_LIMIT = 1e100 # any |income| or |capital| above this has exploded
+        self.GROWTH_LIMIT = 0 # mean |income| growing by more than this factor in a step has exploded. 0 is off
+        self.CONVERGENCE_TOL = 1e-9 # largest relative change of income and capital that counts as converged
+        self.COMMON_NOISE = False # draw shocks from a NoiseBank so every sweep value sees the same ones
 
 
     def set(self, param: str, value: float):
@@ -42,10 +56,20 @@ class Config():
             # raise Warning("Constants are out of proportion. Sim will probably explode.")
             print("Constants are out of proportion. Sim will probably explode.")
 
+    def describe(self) -> dict:
+        """ every field as plain json, enums by name """
+        return {k: v.name if isinstance(v, Enum) else v for k, v in vars(self).items()}
+
 class Globals():
-    def __init__(self):
+    def __init__(self, seed=12345):
         self.n_neighborhoods = 0
         self.t = 0
-        self.rng = default_rng(seed=12345)
+        self.ntrials = 1 # trials advanced together in one timestep
+        self.window = None # timesteps of state kept in memory, None keeps them all
+        self.first_trial = 0 # number of the batch's first trial within the run
+        self.live = None # rows of the batch still running under early stopping, None when all are
+        self.noise = None # NoiseBank when Config.COMMON_NOISE is on
+        self.seed = seed
+        self.rng = default_rng(seed=seed)
         self.logger = Logger('Sim')
         
\ No newline at end of file
@@ -0,0 +1,22 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Experimental designs over several Config fields
+
+from numpy.random import default_rng
+import itertools
+
+
+def full_factorial(grid: dict) -> list:
+    """ every combination of the listed values, as one dict of fields per point.
+        the last field varies fastest """
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def latin_hypercube(bounds: dict, npoints: int, seed=None) -> list:
+    """ npoints spread over the (low, high) range of every field so that each of the
+        npoints equal strata of a field holds exactly one point """
+    rng = default_rng(seed)
+    columns = {}
+    for param, (low, high) in bounds.items():
+        strata = (rng.permutation(npoints) + rng.random(npoints)) / npoints
+        columns[param] = low + (high - low) * strata
+    return [{param: float(column[i]) for param, column in columns.items()} for i in range(npoints)]
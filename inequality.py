@@ -0,0 +1,64 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Vectorized inequality measures over the family axis
+
+import numpy as np
+from numpy import ndarray
+
+
+def _shift_positive(income: ndarray) -> ndarray:
+    """ boost everyone's income in case of negative income """
+    min_income = np.minimum(income.min(axis=-1, keepdims=True), 0)
+    return income - min_income
+
+
+def lorenz(income: ndarray) -> ndarray:
+    """ cumulative income share of the poorest k families, k = 1..N.
+        income is ordered (...) x family, e.g. trial x time x family """
+    positive_income = _shift_positive(income)
+    total_income = positive_income.sum(axis=-1, keepdims=True)
+    _lorenz = np.sort(positive_income, axis=-1).cumsum(axis=-1)
+    return np.true_divide(_lorenz, total_income, out=np.zeros_like(_lorenz), where=total_income>0)
+
+
+def gini(income: ndarray, bins=0) -> ndarray:
+    """ gini of every row of income, ordered (...) x family.
+        bins=0 sorts each row. bins>0 uses the O(N) histogram estimate """
+    income = np.asarray(income, dtype=float)
+    if bins:
+        coef = gini_binned(income, bins)
+    else:
+        coef = .5 - lorenz(income).mean(axis=-1) # unit triangle - integral of lorenz
+    # a row with NaN or inf in it, e.g. a trial stopped for diverging, has no gini
+    return np.where(np.isfinite(income).all(axis=-1), coef, np.nan)
+
+
+def gini_binned(income: ndarray, bins=256) -> ndarray:
+    """ rank-free gini. families are counted into equal width income bins and
+        treated as equal within a bin, so the lorenz curve comes from cumulative
+        bin totals instead of a sort. exact when each bin holds one income level """
+    positive_income = _shift_positive(income)
+    rows = positive_income.reshape(-1, positive_income.shape[-1])
+    nrows = rows.shape[0]
+    low = rows.min(axis=1, keepdims=True)
+    width = (rows.max(axis=1, keepdims=True) - low) / bins
+    with np.errstate(divide='ignore', invalid='ignore'):
+        binned = np.where(width > 0, (rows - low) / width, 0)
+    # the richest family lands on the upper edge, fold it into the last bin
+    binned = np.clip(np.nan_to_num(binned), 0, bins - 1).astype(np.intp)
+    segment = (binned + bins * np.arange(nrows)[:, np.newaxis]).ravel()
+    count = np.bincount(segment, minlength=nrows * bins).reshape(nrows, bins)
+    share = np.bincount(segment, weights=rows.ravel(), minlength=nrows * bins).reshape(nrows, bins)
+    return (.5 - _lorenz_mean(count, share)).reshape(income.shape[:-1])
+
+
+def _lorenz_mean(count: ndarray, share: ndarray) -> ndarray:
+    """ mean of the lorenz curve of rows of groups ordered from poorest up, each
+        group holding count families that earn share between them """
+    total_income = share.sum(axis=-1)
+    below = share.cumsum(axis=-1) - share
+    # within a group the lorenz curve rises by share/count per family
+    area = (count * below + share * (count + 1) / 2).sum(axis=-1)
+    with np.errstate(invalid='ignore'):
+        return np.true_divide(area, total_income * count.sum(axis=-1), out=np.zeros_like(area),
+                              where=total_income>0)
+
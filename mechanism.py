@@ -8,12 +8,46 @@ class SimMech():
     def __init__(self, config: Config, globals: Globals):
         self.config = config
         self.globals = globals
+        # state is laid out trial x family so a batch of trials steps together
+        self.shape = (globals.ntrials, config.N_FAMILIES)
+        # timesteps held in the state arrays. a rolling window wraps around
+        self.depth = globals.window or config.N_TIMESTEPS
+        self.dtype = np.dtype(config.FLOAT_DTYPE)
+
+    def slot(self, lag=0):
+        """ row of the state arrays holding timestep t - lag """
+        return (self.globals.t - lag) % self.depth
         
-    def generate_white_noise(self, size:int, mean=0, var=1, min=None):
-        """returns `size` random samples"""
+    def _compute_edu_efficiency(self, pop: int):
+        """ nu(p) from eq (8). shared by schooling and by neighborhoods weighing newcomers """
+        return edu_efficiency(pop, self.config.EDU_EFFICIENCY_LOWER, self.config.EDU_EFFICIENCY_UPPER,
+                              self.config.N_FAMILIES)
+
+    def generate_white_noise(self, size, mean=0, var=1, min=None, out=None, stream=None):
+        """returns `size` random samples, drawn into `out` if given. a named stream
+            comes from the noise bank when there is one"""
         # any white noise process will do
-        draw = self.globals.rng.normal(mean, var, size)
-        if min is not None:
-            return np.maximum(min, draw)
+        if out is None:
+            draw = self.globals.rng.normal(mean, var, size)
+            if min is not None:
+                return np.maximum(min, draw)
+            else:
+                return draw
+        if stream is not None and self.globals.noise is not None:
+            self.globals.noise.standard_normal(stream, self.globals.t, self.globals.first_trial, out)
         else:
-            return draw
\ No newline at end of file
+            self.globals.rng.standard_normal(out=out, dtype=out.dtype)
+        out *= var
+        out += mean
+        if min is not None:
+            np.maximum(out, min, out=out)
+        return out
+
+
+def edu_efficiency(pop, lower, upper, n_families: int):
+    """ nu(p) from eq (8), lower and upper are lambda_1 and lambda_2. they may be
+        arrays that broadcast against pop """
+    scale = 10 / n_families
+    inflection = n_families / 2
+    sigmoid = lower + (upper - lower) / (1 + np.exp(-scale*(pop - inflection)))
+    return sigmoid * pop
@@ -0,0 +1,92 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Vectorized mobility and segregation measures, computed while the sim runs
+
+from config import Config
+from recorder import Recorder
+from results import SimResultAgg
+from neighborhood import HoodIndex
+import numpy as np
+from numpy import ndarray
+
+
+def _ranks(income: ndarray) -> ndarray:
+    """ 0..N-1 rank of each family within its row, ties broken by order """
+    return np.argsort(np.argsort(income, axis=-1, kind='stable'), axis=-1, kind='stable')
+
+
+def ige(parent: ndarray, child: ndarray) -> ndarray:
+    """ intergenerational elasticity, the slope of log child on log parent income
+        over the families of each row. non-positive incomes are left out """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = (parent > 0) & (child > 0) & np.isfinite(parent) & np.isfinite(child)
+        x = np.log(np.where(valid, parent, 1))
+        y = np.log(np.where(valid, child, 1))
+        count = valid.sum(axis=-1, keepdims=True)
+        x -= x.sum(axis=-1, keepdims=True) / count
+        y -= y.sum(axis=-1, keepdims=True) / count
+        x[~valid] = 0
+        y[~valid] = 0
+        return (x * y).sum(axis=-1) / (x * x).sum(axis=-1)
+
+
+def rank_correlation(parent: ndarray, child: ndarray) -> ndarray:
+    """ spearman correlation between parent and child income ranks of each row """
+    n = parent.shape[-1]
+    d = (_ranks(parent) - _ranks(child)).astype(float)
+    rho = 1 - 6 * (d * d).sum(axis=-1) / (n * (n * n - 1))
+    finite = np.isfinite(parent).all(axis=-1) & np.isfinite(child).all(axis=-1)
+    return np.where(finite, rho, np.nan)
+
+
+def transitions(parent: ndarray, child: ndarray, quantiles=5) -> ndarray:
+    """ counts of families moving from each parent income quantile to each child
+        income quantile, summed over rows. rows with non-finite income are skipped """
+    finite = np.isfinite(parent).all(axis=-1) & np.isfinite(child).all(axis=-1)
+    n = parent.shape[-1]
+    start = _ranks(parent[finite]) * quantiles // n
+    end = _ranks(child[finite]) * quantiles // n
+    counts = np.bincount((start * quantiles + end).ravel(), minlength=quantiles * quantiles)
+    return counts.reshape(quantiles, quantiles)
+
+
+def segregation(income: ndarray, hood: ndarray) -> ndarray:
+    """ two segregation indices of each trial x family row, stacked on the last axis:
+        the neighborhood sorting index, sd of neighborhood mean income over sd of
+        income, and the dissimilarity of families below and above median income """
+    index = HoodIndex(hood, hood.max() + 1)
+    pop = index.population()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = income.mean(axis=-1, keepdims=True)
+        hood_mean = index.sum(income) / pop
+        between = np.where(pop > 0, pop * (hood_mean - mean)**2, 0).sum(axis=-1)
+        nsi = np.sqrt(between / ((income - mean)**2).sum(axis=-1))
+        poor = (income < np.median(income, axis=-1, keepdims=True)).astype(float)
+        poor_share = index.sum(poor) / poor.sum(axis=-1, keepdims=True)
+        rich_share = (pop - index.sum(poor)) / (1 - poor).sum(axis=-1, keepdims=True)
+        dissimilarity = .5 * np.abs(poor_share - rich_share).sum(axis=-1)
+    return np.stack([nsi, dissimilarity], axis=-1)
+
+
+class MobilityRecorder(Recorder):
+    """ mobility between consecutive generations and segregation of each generation,
+        one summary row per trial and timestep plus the transition counts per
+        timestep. only the previous generation's income is held onto """
+    def __init__(self, quantiles=5):
+        self.quantiles = quantiles
+
+    def start(self, config: Config, ntrials: int):
+        self.summary = np.full((ntrials, config.N_TIMESTEPS, 4), np.nan)
+        self.transitions = np.zeros((config.N_TIMESTEPS, self.quantiles, self.quantiles), dtype=np.int64)
+        self.parent = np.empty((ntrials, config.N_FAMILIES), dtype=config.FLOAT_DTYPE)
+
+    def record(self, t: int, income: ndarray, hood: ndarray, pop: ndarray, capital: ndarray):
+        if t > 0:
+            self.summary[:, t, 0] = ige(self.parent, income)
+            self.summary[:, t, 1] = rank_correlation(self.parent, income)
+            self.transitions[t] = transitions(self.parent, income, self.quantiles)
+        self.summary[:, t, 2:] = segregation(income, hood)
+        self.parent[...] = income
+
+    def collect(self, result: SimResultAgg):
+        result.mobility.add_summary(self.summary)
+        result.add_transitions(self.transitions)
@@ -3,32 +3,64 @@
 
 from abc import ABC, abstractmethod
 from config import Config, Globals
-from mechanism import SimMech
+from mechanism import SimMech, edu_efficiency
 import numpy as np
 from numpy import ndarray
 from income import Income
 
 
+class HoodIndex():
+    """ families grouped by neighborhood. built once per timestep by the census """
+    def __init__(self, hood: ndarray, hood_count: int, scratch: ndarray = None):
+        self.shape = (hood.shape[0], hood_count)
+        # flat buffer the size of hood that sum() sorts values into
+        self.scratch = scratch
+        # label each family by (trial, neighborhood) so one index covers the batch
+        offset = hood_count * np.arange(hood.shape[0])[:, np.newaxis]
+        self.segment = (hood + offset).ravel()
+        self.order = np.argsort(self.segment, kind='stable')
+        self.pop = np.bincount(self.segment, minlength=self.shape[0] * hood_count)
+        self.offsets = np.cumsum(self.pop) - self.pop
+
+    def sum(self, values: ndarray):
+        """ totals trial x family values into trial x neighborhood """
+        occupied = self.pop > 0
+        totals = np.zeros(self.pop.size, dtype=values.dtype)
+        ordered = np.take(values.ravel(), self.order, out=self.scratch)
+        # empty segments would break reduceat, each occupied one runs to the next start
+        totals[occupied] = np.add.reduceat(ordered, self.offsets[occupied])
+        return totals.reshape(self.shape)
+
+    def scatter(self, per_hood: ndarray, out: ndarray = None):
+        """ hands each family the value of its neighborhood, into `out` if given """
+        if out is None:
+            return per_hood.ravel()[self.segment].reshape(self.shape[0], -1)
+        np.take(per_hood.ravel().astype(out.dtype, copy=False), self.segment, out=out.reshape(-1))
+        return out
+
+    def population(self):
+        return self.pop.reshape(self.shape)
+
+
 class Neighborhood(ABC, SimMech):
     def __init__(self, config: Config, globals: Globals):
         super().__init__(config, globals)
-        self.hood = np.zeros((config.N_TIMESTEPS, config.N_FAMILIES), dtype=np.int32)
-        self.pop = np.zeros((config.N_TIMESTEPS, config.N_FAMILIES), dtype=np.int32)
+        self.hood = np.zeros((self.depth, *self.shape), dtype=np.int32)
+        self.pop = np.zeros((self.depth, *self.shape), dtype=np.int32)
         equilib = config.UTILITY_CONSUMPTION / (config.UTILITY_CONSUMPTION + self.config.UTILITY_CHILD_INCOME)
         self.taxrate_pref = np.repeat(equilib, config.N_FAMILIES)
         self.hood_count = 0
-
-    @classmethod
-    def _pad_right(cls, arr, length):
-        end_length = length - arr.size
-        margins = (0, end_length)
-        return np.pad(arr, margins, constant_values=0)
+        self.index = None
+        self._taxes = np.empty(self.shape, dtype=self.dtype)
+        self._sorted = np.empty(self.shape[0] * self.shape[1], dtype=self.dtype)
 
     def _census(self):
-        pop = np.bincount(self.hood[self.globals.t, :])
-        padded_pop = Neighborhood._pad_right(pop, self.config.N_FAMILIES) 
-        self.pop[self.globals.t, :] = padded_pop
-        self.hood_count = pop.size
+        hood = self.hood[self.slot()]
+        # the trial with the most neighborhoods decides the width of the index
+        self.hood_count = hood.max() + 1
+        self.index = HoodIndex(hood, self.hood_count, self._sorted)
+        self.pop[self.slot(), :, :self.hood_count] = self.index.population()
+        self.pop[self.slot(), :, self.hood_count:] = 0
 
 
     @abstractmethod
@@ -36,55 +68,137 @@ class Neighborhood(ABC, SimMech):
         """ select into neighborhoods """
         pass    
 
+    def _assign(self, rule, income: Income):
+        """ this timestep's neighborhoods from rule(trial x family income), run only
+            on trials still going. stopped ones keep their last neighborhoods, the sim
+            freezes their state anyway """
+        now, rows = self.slot(), self.globals.live
+        if rows is None:
+            self.hood[now] = rule(income.income[now])
+            return
+        self.hood[now] = self.hood[self.slot(1)]
+        if rows.size:
+            self.hood[now, rows] = rule(income.income[now, rows])
+
     def initialize_neighborhoods(self):
         """ create initial neighborhood selection """
         # this is arbitrary right now
-        selection = np.full(self.config.N_FAMILIES, 0)
-        selection[0 : int(self.config.N_FAMILIES/2)] = 1
-        self.hood[0, :] = selection
+        selection = np.full(self.shape, 0)
+        selection[:, 0 : int(self.config.N_FAMILIES/2)] = 1
+        self.hood[0] = selection
         self._census()
 
 
     def _compute_taxes(self, adult_income: ndarray):
-        taxable = adult_income > 0
-        return np.where(taxable, adult_income, 0) * self.config.TAX_RATE
+        # only positive income is taxable. fmax also leaves NaN income untaxed
+        taxes = np.fmax(adult_income, 0, out=self._taxes)
+        taxes *= self.config.TAX_RATE
+        return taxes
 
 
     def _compute_tax_revenue(self, taxes: ndarray):
-        adult_neighborhood = self.hood[self.globals.t, :]
-        return [taxes[adult_neighborhood == n].sum() for n in range(self.hood_count)]
+        """ returns revenue ordered trial x neighborhood """
+        return self.index.sum(taxes)
 
 
     def collect_taxes(self, income: Income):
-        adult_income = income.income[self.globals.t, :]
+        adult_income = income.income[self.slot()]
         taxes = self._compute_taxes(adult_income)
-        income_after_tax = adult_income - taxes
         taxbase = self._compute_tax_revenue(taxes)
-        income.income[self.globals.t, :] = income_after_tax
+        # leaves income after tax in place
+        adult_income -= taxes
         return taxbase
 
         
 class StaticNeighborhood(Neighborhood):
     def pick_neighborhood(self, income):
         """ select into neighborhoods """
-        self.hood[self.globals.t, :] = self.hood[self.globals.t-1, :]
+        self.hood[self.slot()] = self.hood[self.slot(1)]
         self._census()
 
 class SortedPairsNeighborhood(Neighborhood):
     def pick_neighborhood(self, income):
         """ select into neighborhoods """
-        sorting = np.argsort(income.income[self.globals.t, :])
-        self.hood[self.globals.t, :] = sorting // 2
+        self._assign(lambda rows: np.argsort(rows, axis=1) // 2, income)
         self._census()
 
 class SortedNeighborhood(Neighborhood):
     def pick_neighborhood(self, income):
         """ select into neighborhoods """
-        joining = {}
-        sorting = np.argsort(income.income[self.globals.t, :])
-        for i in range(len(sorting)):
-            for j in range(i+1, len(sorting)):
-                # start from highest income person. add next income person if
-                # they contribute positively to marginal income.
-                pass
-        self._census()
\ No newline at end of file
+        # start from highest income person. add next income person if
+        # they contribute positively to marginal income, ie. the neighborhood's
+        # total child capital does not fall. otherwise they start the next one.
+        self._assign(lambda rows: sorted_neighborhoods(rows, self.config.EDU_EFFICIENCY_LOWER,
+                                                       self.config.EDU_EFFICIENCY_UPPER, self.config.N_FAMILIES),
+                     income)
+        self._census()
+
+
+def child_capital(held: ndarray, held_sq: ndarray, members: ndarray, lower, upper, n_families: int):
+    """ total child human capital of a neighborhood, up to the SKILL_FROM_INCOME
+        and TAX_RATE factors: sum_i y_i * avg_{-i}(y) * D(p) from eqs (8)-(10),
+        written with the sum and sum of squares of member incomes """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        capital = held * (held**2 - held_sq) / ((members - 1) * edu_efficiency(members, lower, upper, n_families))
+    # a lone family has no neighbors to learn from
+    return np.where(members > 1, capital, 0)
+
+
+def sorted_neighborhoods(income: ndarray, lower, upper, n_families: int) -> ndarray:
+    """ neighborhood of each family under the sorting rule, for every trial x family
+        row at once. walks down the ranks, a family joins the neighborhood above it
+        unless that lowers the neighborhood's child capital. lower and upper are
+        lambda_1 and lambda_2, scalars or one per row. a row with NaN or inf in it, e.g.
+        a diverged trial, has no ranking and is left as one neighborhood """
+    nrows = income.shape[0]
+    hood = np.zeros(income.shape, dtype=np.int32)
+    finite = np.isfinite(income).all(axis=1)
+    if finite.any():
+        hood[finite] = _cut_search(income[finite], np.broadcast_to(lower, (nrows,))[finite],
+                                   np.broadcast_to(upper, (nrows,))[finite], n_families)
+    return hood
+
+
+def _cut_search(income: ndarray, lower: ndarray, upper: ndarray, n_families: int) -> ndarray:
+    """ sorted_neighborhoods of finite rows, widening a window of candidates per
+        row until one refuses to join """
+    nrows, nfamilies = income.shape
+    order = np.argsort(-income, axis=1)
+    # bound below by 1 like skill formation. the rule is scale free so
+    # normalize by the richest to keep the cubic terms finite
+    ranked = np.maximum(1, np.take_along_axis(income, order, axis=1))
+    ranked /= ranked[:, :1]
+    zero = np.zeros((nrows, 1))
+    prefix = np.concatenate((zero, np.cumsum(ranked, axis=1)), axis=1)
+    prefix_sq = np.concatenate((zero, np.cumsum(ranked**2, axis=1)), axis=1)
+    cuts = np.zeros(income.shape, dtype=np.int32)
+    start = np.zeros(nrows, dtype=np.intp)
+    window = np.full(nrows, 16)
+    active = np.arange(nrows)
+    # each pass finds the next cut of every row still going, one neighborhood per pass
+    while active.size:
+        rows = active[:, np.newaxis]
+        # candidate start+j joins if j members already have, so only the first refusal counts
+        members = np.arange(1, window[active].max())
+        at = start[active, np.newaxis] + members
+        valid = (members < window[rows]) & (at < nfamilies)
+        at = np.minimum(at, nfamilies - 1)
+        held = prefix[rows, at] - prefix[rows, start[rows]]
+        held_sq = prefix_sq[rows, at] - prefix_sq[rows, start[rows]]
+        candidate = ranked[rows, at]
+        lo, hi = lower[rows], upper[rows]
+        joined = (child_capital(held + candidate, held_sq + candidate**2, members + 1, lo, hi, n_families) >=
+                  child_capital(held, held_sq, members, lo, hi, n_families))
+        refused = valid & ~joined
+        found = refused.any(axis=1)
+        cut = active[found]
+        start[cut] += np.argmax(refused[found], axis=1) + 1
+        cuts[cut, start[cut]] = 1
+        window[cut] = 16
+        # no refusal yet: widen the window, or the rest of the row is one neighborhood
+        searching = active[~found]
+        window[searching] *= 2
+        active = np.concatenate((cut, searching[start[searching] + window[searching] // 2 < nfamilies]))
+    hood = np.empty_like(cuts)
+    np.put_along_axis(hood, order, np.cumsum(cuts, axis=1, dtype=np.int32), axis=1)
+    return hood
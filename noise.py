@@ -0,0 +1,33 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Common random numbers shared by every run with the same seed
+
+from numpy import ndarray
+from numpy.random import Generator, Philox
+
+
+class NoiseBank():
+    """ Standard normal shocks regenerated on demand from (seed, stream, trial,
+        timestep). Nothing is stored, yet trial k at timestep t sees the same shocks
+        in every sweep value, batch size and worker, so neighboring sweep values
+        differ by their parameter and not by their luck. """
+    STREAMS = {"skill": 0, "income": 1}
+
+    def __init__(self, seed: int):
+        self.seed = seed
+        self._bit_generator = Philox(key=seed)
+        self._rng = Generator(self._bit_generator)
+        self._state = self._bit_generator.state
+
+    def _seek(self, stream: str, t: int, trial: int):
+        # philox is counter based, every block starts at its own counter
+        self._state["state"]["counter"][:] = [0, t, trial, NoiseBank.STREAMS[stream]]
+        self._state["buffer_pos"] = 4 # drop anything left buffered from the last block
+        self._state["has_uint32"] = 0
+        self._bit_generator.state = self._state
+
+    def standard_normal(self, stream: str, t: int, first_trial: int, out: ndarray) -> ndarray:
+        """ fills `out`, ordered trial x family, for trials first_trial onwards """
+        for row in range(out.shape[0]):
+            self._seek(stream, t, first_trial + row)
+            self._rng.standard_normal(out=out[row], dtype=out.dtype)
+        return out
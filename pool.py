@@ -0,0 +1,51 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Pool of mechanisms reused across trials and sweep values
+
+from config import Config, Globals, HoodFormation
+from income import Income
+from human_capital import HumanCapital
+from neighborhood import StaticNeighborhood, SortedPairsNeighborhood, SortedNeighborhood
+from collections import OrderedDict
+import numpy as np
+
+NEIGHBORHOODS = {
+    HoodFormation.STATIC : StaticNeighborhood,
+    HoodFormation.PERFECT_SORTING_PAIRS : SortedPairsNeighborhood,
+    HoodFormation.PERFECT_SORTING : SortedNeighborhood,
+}
+
+
+class MechanismPool():
+    """ Mechanisms keyed by everything that fixes their arrays: the state shape, the
+        neighborhood formation and the float dtype. A trial that matches a pooled key
+        reuses its arrays in place, each initialize_* resets them. Only the `capacity`
+        most recently used keys are kept so size sweeps don't pile up memory. """
+    def __init__(self, capacity=4):
+        self.capacity = capacity
+        self.mechanisms = OrderedDict()
+
+    @classmethod
+    def key(cls, config: Config, globals: Globals) -> tuple:
+        depth = globals.window or config.N_TIMESTEPS
+        return ((depth, globals.ntrials, config.N_FAMILIES), config.HOOD_FORMATION, np.dtype(config.FLOAT_DTYPE))
+
+    def acquire(self, config: Config, globals: Globals) -> tuple:
+        """ income, capital and neighborhood mechanisms for the current config """
+        key = MechanismPool.key(config, globals)
+        if key in self.mechanisms:
+            self.mechanisms.move_to_end(key)
+            mechanisms = self.mechanisms[key]
+            for mech in mechanisms:
+                # the sim may have swapped in a different config since
+                mech.config = config
+                mech.globals = globals
+            return mechanisms
+        hood_class = NEIGHBORHOODS.get(config.HOOD_FORMATION, StaticNeighborhood)
+        mechanisms = (Income(config, globals), HumanCapital(config, globals), hood_class(config, globals))
+        self.mechanisms[key] = mechanisms
+        while len(self.mechanisms) > self.capacity:
+            self.mechanisms.popitem(last=False)
+        return mechanisms
+
+    def clear(self):
+        self.mechanisms.clear()
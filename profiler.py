@@ -0,0 +1,70 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Per-phase timers, allocation counters and call counts for the Sim
+
+import time
+import tracemalloc
+
+
+class PhaseStats():
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+        self.peak_bytes = 0 # largest allocation spike seen in one call
+        self.net_bytes = 0 # memory left allocated after the calls, summed
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.peak_bytes = max(self.peak_bytes, other.peak_bytes)
+        self.net_bytes += other.net_bytes
+
+
+class Profiler():
+    """ Attach to Sim.profiler to time every phase of every timestep. Sim skips
+        all of this when profiler is None. on_enter(phase, t) and on_exit(phase, t, seconds)
+        are called around each phase if given. track_memory turns on tracemalloc,
+        which is accurate for numpy arrays but slows the run down noticeably. """
+    def __init__(self, track_memory=False, on_enter=None, on_exit=None):
+        self.track_memory = track_memory
+        self.on_enter = on_enter
+        self.on_exit = on_exit
+        self.stats = {}
+
+    def measure(self, phase: str, t: int, fn, *args):
+        if self.on_enter is not None:
+            self.on_enter(phase, t)
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        out = fn(*args)
+        seconds = time.perf_counter() - start
+        stats = self.stats.setdefault(phase, PhaseStats())
+        stats.calls += 1
+        stats.seconds += seconds
+        if self.track_memory:
+            after, peak = tracemalloc.get_traced_memory()
+            stats.peak_bytes = max(stats.peak_bytes, peak - before)
+            stats.net_bytes += after - before
+        if self.on_exit is not None:
+            self.on_exit(phase, t, seconds)
+        return out
+
+    def merge(self, stats: dict):
+        """ folds in stats from another profiler, e.g. one that ran in a worker process """
+        for phase, other in stats.items():
+            self.stats.setdefault(phase, PhaseStats()).merge(other)
+
+    def reset(self):
+        self.stats = {}
+
+    def report(self) -> str:
+        total = sum(s.seconds for s in self.stats.values())
+        lines = [f"{'phase':<24}{'calls':>8}{'total s':>11}{'per call ms':>13}{'share':>8}{'peak MiB':>10}"]
+        for phase, s in sorted(self.stats.items(), key=lambda item: -item[1].seconds):
+            share = s.seconds / total if total else 0
+            lines.append(f"{phase:<24}{s.calls:>8}{s.seconds:>11.4f}{1e3 * s.seconds / max(1, s.calls):>13.4f}"
+                         f"{share:>8.1%}{s.peak_bytes / 2**20:>10.2f}")
+        return "\n".join(lines)
@@ -0,0 +1,102 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Recorders that keep history while the mechanisms roll over their state
+
+from config import Config
+from results import SimResultAgg, summarize, stats_for
+import numpy as np
+from numpy import ndarray
+
+
+class Recorder():
+    """ Watches the live state after every timestep. When a recorder is in use the
+        mechanisms only keep the last two timesteps, so whatever history survives
+        the run is what the recorder saved. """
+    def begin(self, config: Config, ntrials: int):
+        """ called once before a run's batches, with how many trials they hold """
+        pass
+
+    def start(self, config: Config, ntrials: int):
+        """ called before every batch of trials """
+        pass
+
+    def record(self, t: int, income: ndarray, hood: ndarray, pop: ndarray, capital: ndarray):
+        """ state at timestep t, each ordered trial x family """
+        pass
+
+    def collect(self, result: SimResultAgg):
+        """ hand the recorded batch over to the results """
+        pass
+
+    def end(self):
+        """ called once after a run's last batch """
+        pass
+
+
+class SnapshotRecorder(Recorder):
+    """ keeps the full state every `every` timesteps """
+    def __init__(self, every=1):
+        self.every = every
+        self.times = np.empty(0, dtype=int)
+
+    def start(self, config: Config, ntrials: int):
+        self.times = np.arange(0, config.N_TIMESTEPS, self.every)
+        shape = (self.times.size, ntrials, config.N_FAMILIES)
+        self.income = np.zeros(shape, dtype=config.FLOAT_DTYPE)
+        self.hood = np.zeros(shape, dtype=np.int32)
+        self.pop = np.zeros(shape, dtype=np.int32)
+        self.capital = np.zeros(shape, dtype=config.FLOAT_DTYPE)
+
+    def record(self, t: int, income: ndarray, hood: ndarray, pop: ndarray, capital: ndarray):
+        if t % self.every == 0:
+            snap = t // self.every
+            self.income[snap] = income
+            self.hood[snap] = hood
+            self.pop[snap] = pop
+            self.capital[snap] = capital
+
+    def collect(self, result: SimResultAgg):
+        # result rows are snapshots, times maps them back to timesteps
+        result.add_batch(*(np.moveaxis(state, 1, 0) for state in (self.income, self.pop, self.capital)))
+
+
+class SummaryRecorder(Recorder):
+    """ keeps only the per-timestep summary statistics of each trial """
+    def start(self, config: Config, ntrials: int):
+        self.gini_bins = config.GINI_BINS
+        self.summaries = {name: np.zeros((ntrials, config.N_TIMESTEPS, len(stats_for(name))))
+                          for name in ["Income", "Neighborhood Size", "Capital"]}
+
+    def record(self, t: int, income: ndarray, hood: ndarray, pop: ndarray, capital: ndarray):
+        for name, values in [("Income", income), ("Neighborhood Size", pop), ("Capital", capital)]:
+            self.summaries[name][:, t] = summarize(values[:, np.newaxis], stats_for(name), self.gini_bins)[:, 0]
+
+    def collect(self, result: SimResultAgg):
+        result.income.add_summary(self.summaries["Income"])
+        result.neighborhood_size.add_summary(self.summaries["Neighborhood Size"])
+        result.human_capital.add_summary(self.summaries["Capital"])
+
+
+class RecorderGroup(Recorder):
+    """ several recorders watching the same run """
+    def __init__(self, *recorders: Recorder):
+        self.recorders = recorders
+
+    def begin(self, config: Config, ntrials: int):
+        for recorder in self.recorders:
+            recorder.begin(config, ntrials)
+
+    def start(self, config: Config, ntrials: int):
+        for recorder in self.recorders:
+            recorder.start(config, ntrials)
+
+    def record(self, t: int, income: ndarray, hood: ndarray, pop: ndarray, capital: ndarray):
+        for recorder in self.recorders:
+            recorder.record(t, income, hood, pop, capital)
+
+    def collect(self, result: SimResultAgg):
+        for recorder in self.recorders:
+            recorder.collect(result)
+
+    def end(self):
+        for recorder in self.recorders:
+            recorder.end()
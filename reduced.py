@@ -0,0 +1,370 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Reduced-form engine for screening parameter space quickly
+# Description: Runs the back-substituted recursion from equations.md,
+#   Y_{i,t+1} ~ alpha + beta Y_i + phi tau xi Ybar_n theta(zeta(Y_i, Ybar_n)) / lambda + eps,
+#   for every trial of every sweep value at once. static neighborhoods step the
+#   first two moments of Y and eps in each neighborhood instead of every family
+
+from config import Config, Globals, HoodFormation, TrialStatus
+from mechanism import edu_efficiency
+from neighborhood import sorted_neighborhoods
+from results import SimResultAgg, SimResultSweep, summarize, stats_for, _pandas
+from noise import NoiseBank
+from statistics import NormalDist
+import numpy as np
+from numpy import ndarray
+import warnings
+import math
+import copy
+import time
+
+# parameters that can differ between rows of one batch
+ROW_PARAMS = ["INCOME_GROWTH", "PARENTAL_INVESTMENT_COEF", "SKILL_FROM_INCOME", "CAPITAL_EFFICIENCY",
+              "INCOME_NOISE_ADDITIVE", "INCOME_NOISE_AUTOREG", "SKILL_NOISE_SD", "TAX_RATE",
+              "EDU_EFFICIENCY_UPPER", "EDU_EFFICIENCY_LOWER"]
+# parameters that fix the shape of a batch, sweeping them runs one batch per value
+SHAPE_PARAMS = ["N_FAMILIES", "N_TIMESTEPS", "HOOD_FORMATION", "FLOAT_DTYPE", "COMMON_NOISE"]
+# results kept for every timestep, by SimResultAgg field and summary name
+SUMMARIES = {"income": "Income", "neighborhood_size": "Neighborhood Size", "human_capital": "Capital"}
+# mean and variance of a family's income shock, max(0, 1 + z)
+SHOCK_MEAN = NormalDist().cdf(1) + NormalDist().pdf(1)
+SHOCK_VAR = 2 * NormalDist().cdf(1) + NormalDist().pdf(1) - SHOCK_MEAN**2
+_erf = np.frompyfunc(math.erf, 1, 1)
+
+
+def _cdf(z: ndarray) -> ndarray:
+    """ standard normal cdf, element by element """
+    return .5 * (1 + _erf(np.asarray(z) / np.sqrt(2)).astype(float))
+
+
+class ReducedSim():
+    """ Skill comes from the neighborhood mean instead of the mean of the other
+        neighbors, so a timestep only needs per-neighborhood means and no mechanisms.
+        Static neighborhoods carry only the means and variances of income and its
+        noise, with income taken as normal within a neighborhood for the floors, the
+        sd and the gini. Sorted neighborhoods need every family's rank and still step
+        each family. Parameters are carried per row, which lets a whole
+        sweep step as one batch. Early stopping does not apply, diverging rows just
+        run on. """
+    def __init__(self, config: Config = None, seed=12345):
+        self.config = config or Config()
+        self.globals = Globals(seed)
+
+
+    @property
+    def gini_bins(self) -> int:
+        return self.config.GINI_BINS
+
+
+    def set(self, param: str, value: float):
+        self.config.set(param, value)
+
+
+    @classmethod
+    def _params(cls, configs: list, ntrials: int) -> dict:
+        """ every row parameter as a column, ntrials rows per config """
+        return {param: np.repeat([getattr(config, param) for config in configs], ntrials)[:, np.newaxis]
+                for param in ROW_PARAMS}
+
+
+    def _pick_neighborhood(self, formation: HoodFormation, income: ndarray, hood: ndarray, p: dict) -> ndarray:
+        if formation == HoodFormation.PERFECT_SORTING_PAIRS:
+            return (np.argsort(income, axis=1) // 2).astype(np.int32)
+        if formation == HoodFormation.PERFECT_SORTING:
+            return sorted_neighborhoods(income, p["EDU_EFFICIENCY_LOWER"][:, 0], p["EDU_EFFICIENCY_UPPER"][:, 0],
+                                        income.shape[1])
+        return hood
+
+
+    def _draw(self, stream: str, t: int, out: ndarray, nconfigs: int, bank: NoiseBank) -> ndarray:
+        """ standard normals into out. from the bank each config's trials are numbered
+            from 0, so they see the same shocks as the full model's trials """
+        if bank is None:
+            return self.globals.rng.standard_normal(out=out, dtype=out.dtype)
+        ntrials = out.shape[0] // nconfigs
+        for i in range(nconfigs):
+            bank.standard_normal(stream, t, 0, out[i * ntrials : (i + 1) * ntrials])
+        return out
+
+
+    def _simulate(self, configs: list, ntrials: int) -> dict:
+        """ configs share every SHAPE_PARAMS value. returns the row x time x stat
+            summaries of SUMMARIES, ntrials rows per config. only the current
+            generation is held, each timestep is summarized as soon as it is made """
+        config = configs[0]
+        if config.HOOD_FORMATION == HoodFormation.STATIC:
+            return self._simulate_means(configs, ntrials)
+        p = self._params(configs, ntrials)
+        nrows, nfamilies = len(configs) * ntrials, config.N_FAMILIES
+        shape = (nrows, nfamilies)
+        dtype = np.dtype(config.FLOAT_DTYPE)
+        bank = NoiseBank(self.globals.seed) if config.COMMON_NOISE else None
+        summaries = {name: np.zeros((nrows, config.N_TIMESTEPS, len(stats_for(label))))
+                     for name, label in SUMMARIES.items()}
+        hood = ReducedSim._static_hood(shape)
+        offset = np.arange(nrows)[:, np.newaxis]
+        y = np.ones(shape, dtype=dtype)
+        noise = np.zeros(shape, dtype=dtype)
+        capital = np.zeros(shape, dtype=dtype)
+        xi = np.empty(shape, dtype=dtype)
+        shock = np.empty(shape, dtype=dtype)
+        sizes = np.zeros(shape, dtype=np.int32) # neighborhood populations padded like Neighborhood.pop
+        # screening runs straight through unstable regions, they show up as inf and NaN
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            for t in range(config.N_TIMESTEPS):
+                if t > 0:
+                    # same draws in the same order as the full model
+                    self._draw("skill", t, xi, len(configs), bank)
+                    xi *= p["SKILL_NOISE_SD"]
+                    xi += 1
+                    self._draw("income", t, shock, len(configs), bank)
+                    shock += 1
+                    np.maximum(shock, 0, out=shock)
+                    noise *= p["INCOME_NOISE_AUTOREG"]
+                    noise += p["INCOME_NOISE_ADDITIVE"] * shock
+                    capital *= xi
+                    capital *= p["CAPITAL_EFFICIENCY"]
+                    y *= p["PARENTAL_INVESTMENT_COEF"]
+                    y += p["INCOME_GROWTH"]
+                    y += capital
+                    y += noise
+                    hood = self._pick_neighborhood(config.HOOD_FORMATION, y, hood, p)
+                hood_count = hood.max() + 1
+                segment = (hood + hood_count * offset).ravel()
+                members = np.bincount(segment, minlength=nrows * hood_count).reshape(nrows, hood_count)
+                econ = edu_efficiency(members, p["EDU_EFFICIENCY_LOWER"], p["EDU_EFFICIENCY_UPPER"], nfamilies)
+                sizes[:, :hood_count] = members
+                sizes[:, hood_count:] = 0
+                taxes = np.fmax(y, 0)
+                taxes *= p["TAX_RATE"]
+                y -= taxes
+                parent = np.maximum(1, y)
+                # tau Ybar_n / lambda is the revenue over nu(p), Ybar_n includes the family itself
+                revenue = np.bincount(segment, weights=taxes.ravel(), minlength=members.size).reshape(members.shape)
+                held = np.bincount(segment, weights=parent.ravel(), minlength=members.size).reshape(members.shape)
+                schooling = np.divide(revenue * held, econ * members, out=np.zeros(members.shape), where=members > 0)
+                np.multiply(parent, schooling.ravel()[segment].reshape(shape), out=capital)
+                capital *= p["SKILL_FROM_INCOME"]
+                for name, values in (("income", y), ("neighborhood_size", sizes), ("human_capital", capital)):
+                    summaries[name][:, t] = summarize(values[:, np.newaxis], stats_for(SUMMARIES[name]),
+                                                      self.gini_bins)[:, 0]
+        return summaries
+
+
+    @classmethod
+    def _static_hood(cls, shape: tuple) -> ndarray:
+        """ the full model's starting neighborhoods, which static ones keep """
+        hood = np.zeros(shape, dtype=np.int32)
+        hood[:, 0 : int(shape[1]/2)] = 1
+        return hood
+
+
+    def _hood_draws(self, t: int, xi: ndarray, shock: ndarray, members: ndarray, nconfigs: int, bank: NoiseBank):
+        """ neighborhood means of the skill and income shocks. from the bank they are
+            the means of the full model's own shocks, otherwise they are drawn
+            directly from their sampling distribution """
+        if bank is None:
+            spread = 1 / np.sqrt(np.maximum(members, 1))
+            self.globals.rng.standard_normal(out=xi)
+            xi *= spread
+            self.globals.rng.standard_normal(out=shock)
+            shock *= np.sqrt(SHOCK_VAR) * spread
+            shock += SHOCK_MEAN
+            return
+        nrows, hood_count = members.shape
+        families = np.empty((nrows, members[0].sum()))
+        segment = (ReducedSim._static_hood(families.shape) + hood_count * np.arange(nrows)[:, np.newaxis]).ravel()
+        self._draw("skill", t, families, nconfigs, bank)
+        xi[...] = np.bincount(segment, weights=families.ravel(), minlength=members.size).reshape(members.shape)
+        self._draw("income", t, families, nconfigs, bank)
+        families += 1
+        np.maximum(families, 0, out=families)
+        shock[...] = np.bincount(segment, weights=families.ravel(), minlength=members.size).reshape(members.shape)
+        np.divide(xi, members, out=xi, where=members > 0)
+        np.divide(shock, members, out=shock, where=members > 0)
+
+
+    @classmethod
+    def _censor(cls, mean: ndarray, var: ndarray, floor: float) -> tuple:
+        """ mean and variance of max(floor, X) for normal X, and its covariance with
+            X over var(X), which by Stein's lemma carries over to anything jointly
+            normal with X """
+        sd = np.sqrt(var)
+        gap = mean - floor
+        z = gap / np.where(sd > 0, sd, 1)
+        slope = np.where(sd > 0, _cdf(z), gap > 0)
+        density = np.where(sd > 0, np.exp(-z**2 / 2) / np.sqrt(2 * np.pi), 0)
+        above = gap * slope + sd * density
+        above_sq = (gap**2 + var) * slope + gap * sd * density
+        return floor + above, np.maximum(above_sq - above**2, 0), slope
+
+
+    @classmethod
+    def _moment_summary(cls, mean: ndarray, var: ndarray, members: ndarray, stats: list) -> ndarray:
+        """ row x stat summary of families spread normally within each neighborhood """
+        nfamilies = members.sum(axis=1)
+        weight = members / nfamilies[:, np.newaxis]
+        mean, var = np.where(members > 0, mean, 0), np.where(members > 0, var, 0)
+        overall = (weight * mean).sum(axis=1)
+        spread = (members * (var + (mean - overall[:, np.newaxis])**2)).sum(axis=1)
+        summary = [overall, np.sqrt(spread / (nfamilies - 1))]
+        if "gini" in stats:
+            # mean absolute difference of two families, pair by pair of neighborhoods
+            gap = mean[:, :, np.newaxis] - mean[:, np.newaxis, :]
+            sd = np.sqrt(var[:, :, np.newaxis] + var[:, np.newaxis, :])
+            z = gap / np.where(sd > 0, sd, 1)
+            apart = np.where(sd > 0, gap * (2 * _cdf(z) - 1) + 2 * sd * np.exp(-z**2 / 2) / np.sqrt(2 * np.pi),
+                             np.abs(gap))
+            difference = (weight[:, :, np.newaxis] * weight[:, np.newaxis, :] * apart).sum(axis=(1, 2))
+            # gini() is the area between the diagonal and the lorenz curve over N
+            # families, half the mean difference over the mean less 1/2N
+            # with no income at all the lorenz curve is flat, as in gini()
+            summary.append(np.where(overall == 0, .5, difference / (4 * overall) - 1 / (2 * nfamilies)))
+        return np.stack(summary, axis=-1)
+
+
+    def _simulate_means(self, configs: list, ntrials: int) -> dict:
+        """ _simulate for static neighborhoods. each row x neighborhood steps the mean
+            and variance of income and of its MA(1) noise and their covariance, income
+            taken as normal within a neighborhood wherever it meets a floor """
+        config = configs[0]
+        p = self._params(configs, ntrials)
+        nrows, nfamilies = len(configs) * ntrials, config.N_FAMILIES
+        bank = NoiseBank(self.globals.seed) if config.COMMON_NOISE else None
+        members = np.repeat(np.bincount(ReducedSim._static_hood((1, nfamilies))[0])[np.newaxis], nrows, axis=0)
+        econ = edu_efficiency(members, p["EDU_EFFICIENCY_LOWER"], p["EDU_EFFICIENCY_UPPER"], nfamilies)
+        y, y_var = np.ones(members.shape), np.zeros(members.shape)
+        noise, noise_var = np.zeros(members.shape), np.zeros(members.shape)
+        covar = np.zeros(members.shape) # of income and noise
+        parent, parent_var, parent_slope = np.ones(members.shape), np.zeros(members.shape), np.ones(members.shape)
+        gain = np.zeros(members.shape) # capital per unit of parent income
+        xi = np.empty(members.shape)
+        shock = np.empty(members.shape)
+        summaries = {name: np.zeros((nrows, config.N_TIMESTEPS, len(stats_for(label))))
+                     for name, label in SUMMARIES.items()}
+        sizes = np.zeros((nrows, nfamilies), dtype=np.int32)
+        sizes[:, :members.shape[1]] = members
+        summaries["neighborhood_size"][...] = summarize(sizes[:, np.newaxis], stats_for("Neighborhood Size"))
+        beta, rho = p["PARENTAL_INVESTMENT_COEF"], p["INCOME_NOISE_AUTOREG"]
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            for t in range(config.N_TIMESTEPS):
+                if t > 0:
+                    self._hood_draws(t, xi, shock, members, len(configs), bank)
+                    xi *= p["SKILL_NOISE_SD"]
+                    xi += 1
+                    k = p["CAPITAL_EFFICIENCY"] * gain
+                    # each family's own skill and income shocks, for the spread within
+                    invested_var = k**2 * ((1 + p["SKILL_NOISE_SD"]**2) * (parent_var + parent**2) - parent**2)
+                    noise_var = rho**2 * noise_var + p["INCOME_NOISE_ADDITIVE"]**2 * SHOCK_VAR
+                    noise_covar = rho * covar # of last income and the new noise
+                    noise = rho * noise + p["INCOME_NOISE_ADDITIVE"] * shock
+                    y_var, covar = (beta**2 * y_var + invested_var + noise_var
+                                    + 2 * beta * k * parent_slope * y_var + 2 * beta * noise_covar
+                                    + 2 * k * parent_slope * noise_covar,
+                                    beta * noise_covar + k * parent_slope * noise_covar + noise_var)
+                    y = p["INCOME_GROWTH"] + beta * y + k * xi * parent + noise
+                taxed, taxed_var, taxed_slope = ReducedSim._censor(y, y_var, 0)
+                y = y - p["TAX_RATE"] * taxed
+                y_var = np.maximum(y_var * (1 - 2 * p["TAX_RATE"] * taxed_slope) + p["TAX_RATE"]**2 * taxed_var, 0)
+                covar = covar * (1 - p["TAX_RATE"] * taxed_slope)
+                parent, parent_var, parent_slope = ReducedSim._censor(y, y_var, 1)
+                schooling = np.divide(p["TAX_RATE"] * taxed * members * parent, econ, out=np.zeros(members.shape),
+                                      where=members > 0)
+                gain = p["SKILL_FROM_INCOME"] * schooling
+                summaries["income"][:, t] = ReducedSim._moment_summary(y, y_var, members, stats_for("Income"))
+                summaries["human_capital"][:, t] = ReducedSim._moment_summary(gain * parent, gain**2 * parent_var,
+                                                                               members, stats_for("Capital"))
+        return summaries
+
+
+    def _agg(self, summaries: dict) -> SimResultAgg:
+        result = SimResultAgg(gini_bins=self.gini_bins)
+        for name, summary in summaries.items():
+            getattr(result, name).add_summary(summary)
+        ntrials, ntimesteps = summaries["income"].shape[:2]
+        result.add_status(np.full(ntrials, TrialStatus.COMPLETED.value), np.full(ntrials, ntimesteps))
+        return result
+
+
+    def run(self, ntrials=1) -> SimResultAgg:
+        return self._agg(self._simulate([self.config], ntrials))
+
+
+    def _configs(self, param: str, values: list) -> list:
+        configs = []
+        for value in values:
+            config = copy.copy(self.config)
+            config.set(param, value)
+            configs.append(config)
+        return configs
+
+
+    def _run_values(self, param: str, values: list, ntrials: int) -> list:
+        """ one agg per value, in one batch unless param changes the shape """
+        configs = self._configs(param, values)
+        groups = [[config] for config in configs] if param in SHAPE_PARAMS else [configs]
+        results = []
+        for group in groups:
+            summaries = self._simulate(group, ntrials)
+            for i in range(len(group)):
+                rows = slice(i * ntrials, (i + 1) * ntrials)
+                results.append(self._agg({name: summary[rows] for name, summary in summaries.items()}))
+        return results
+
+
+    def run_sweep(self, param: str, values: list, ntrials=1) -> SimResultSweep:
+        result = SimResultSweep()
+        for value, agg in zip(values, self._run_values(param, values, ntrials)):
+            result.add(agg, value)
+        return result
+
+
+    def compare(self, ntrials=1, param: str = None, values: list = None, batched=True):
+        """ runs the full model on the same configs and reports, per value, the largest
+            relative deviation over time of each trial-averaged statistic, along with
+            how much faster the reduced form was """
+        from sim import Sim
+        sim = Sim()
+        sim.globals = Globals(self.globals.seed)
+        configs = [self.config] if param is None else self._configs(param, values)
+        started = time.perf_counter()
+        full = []
+        for config in configs:
+            sim.config = config
+            full.append(sim.run(ntrials, batched=batched))
+        full_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        reduced = [self.run(ntrials)] if param is None else self._run_values(param, values, ntrials)
+        reduced_seconds = time.perf_counter() - started
+        report = {}
+        for exact, approx in zip(full, reduced):
+            for name in ["income", "neighborhood_size", "human_capital"]:
+                exact_data, approx_data = getattr(exact, name), getattr(approx, name)
+                deviation = ReducedSim._deviation(ReducedSim._curves(exact_data), ReducedSim._curves(approx_data))
+                for stat, error in zip(exact_data.stats, deviation):
+                    report.setdefault(f"{exact_data.name} {stat}", []).append(error)
+        report["speedup"] = [full_seconds / reduced_seconds] * len(configs)
+        pd = _pandas()
+        return pd.DataFrame(report, index=pd.Index([None] if param is None else values, name="Param"))
+
+
+    @classmethod
+    def _curves(cls, data) -> ndarray:
+        """ time x stat average over the trials of a SimResultAggData """
+        columns = data.columns.reshape(data.columns.shape[0], data.ntrials, len(data.stats))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanmean(columns, axis=1)
+
+
+    @classmethod
+    def _deviation(cls, exact: ndarray, approx: ndarray) -> ndarray:
+        """ largest relative error over time of each column of time x stat curves.
+            NaN on one side only counts as an infinite error """
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # a column that is zero at some timesteps, e.g. the sd before any shocks,
+            # is round-off there and measured against the column's own scale
+            scale = 1e-9 * np.nanmax(np.where(np.isfinite(exact), np.abs(exact), np.nan), axis=0)
+            error = np.abs(approx - exact) / np.maximum(np.abs(exact), np.fmax(scale, np.finfo(float).tiny))
+        error = np.where(np.isnan(exact) & np.isnan(approx), 0, error)
+        return np.where(np.isnan(error), np.inf, error).max(axis=0)
@@ -1,21 +1,45 @@
 # Author: Eric Chandler <echandler@uchicago.edu>
 # Brief: Data structure for simulation results
 
-from pandas.core.frame import DataFrame
-from mechanism import SimMech
+from __future__ import annotations
 import numpy as np
 from numpy import ndarray
-import pandas as pd
-import seaborn as sns
+import warnings
+import inequality
+from config import TrialStatus
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+
+# pandas and seaborn (and matplotlib through it) take longer to import than a
+# small sim takes to run, so they only load once a frame or plot is asked for
+def _pandas():
+    import pandas
+    return pandas
+
+
+def _seaborn():
+    import seaborn
+    return seaborn
 
 class SimResultData():
-        def __init__(self, result: SimMech, name: str):
-            cols = [f"family_{i}" for i in range(result.shape[1])]
-            self.data = pd.DataFrame(result, columns=cols)
+        def __init__(self, result: ndarray, name: str):
+            self.values = result
             self.name = name
+            self._data = None
+
+        @property
+        def data(self) -> DataFrame:
+            """ wide time x family frame, only built once someone asks for it """
+            if self._data is None:
+                pd = _pandas()
+                cols = [f"family_{i}" for i in range(self.values.shape[1])]
+                self._data = pd.DataFrame(self.values, columns=cols)
+            return self._data
 
         def plot(self):
-            sns.relplot(data=self.data, kind='line', legend=False).set(title=self.name)
+            _seaborn().relplot(data=self.data, kind='line', legend=False).set(title=self.name)
     
 
 class SimResult():
@@ -25,45 +49,120 @@ class SimResult():
         self.neighborhood = SimResultData(neighborhood, "Neighborhoods")
         self.neighborhood_size = SimResultData(population, "Neighborhood Size")
         self.human_capital = SimResultData(human_capital, "Capital")
+        self.status = TrialStatus.COMPLETED
+        self.stop_step = income.shape[0]
+
+
+class RunningMoments():
+    """ online mean and variance of each row, skipping NaN like pandas does.
+        merges whole blocks of columns at once (Chan's pairwise form of Welford) """
+    def __init__(self, size: int):
+        self.count = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    def add(self, values: ndarray):
+        """ values is ordered row x column """
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=1)
+        total = self.count + count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(valid, values, 0).sum(axis=1) / count
+            m2 = (np.where(valid, values - mean[:, np.newaxis], 0) ** 2).sum(axis=1)
+            delta = mean - self.mean
+            self.mean = np.where(count > 0, self.mean + delta * count / total, self.mean)
+            self.m2 = np.where(count > 0, self.m2 + m2 + delta ** 2 * self.count * count / total, self.m2)
+        self.count = total
+
+    def std(self, ddof=1):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan))
+
+
+def summarize(values: ndarray, stats: list, gini_bins=0) -> ndarray:
+    """ trial x time x stat summary of trial x time x family values """
+    with warnings.catch_warnings():
+        # all-NaN rows come out NaN, same as pandas
+        warnings.simplefilter("ignore", RuntimeWarning)
+        summary = [np.nanmean(values, axis=-1), np.nanstd(values, axis=-1, ddof=1)]
+    if "gini" in stats:
+        summary.append(SimResultAggData.gini(values, gini_bins))
+    return np.stack(summary, axis=-1)
+
+
+def stats_for(name: str) -> list:
+    if name == "Mobility":
+        return ["ige", "rankcorr", "nsi", "dissimilarity"]
+    return ["mean", "sd", "gini"] if name in ["Income", "Capital"] else ["mean", "sd"]
 
 
 class SimResultAggData():
-    def __init__(self, name: str, keep_trials=False):
-        self.data = pd.DataFrame()
+    def __init__(self, name: str, keep_trials=False, gini_bins=0):
         self.name = name
+        self.gini_bins = gini_bins
         self.ntrials = 0
         self.trial_data = []
         self.keep_trials = keep_trials
+        self.stats = stats_for(name)
+        # per-trial summaries ordered time x (trial, stat), grown by doubling
+        self._columns = None
+        self.moments = None
+        self._data = None
 
     @classmethod
-    def gini(cls, income_df: DataFrame):
-        """ income is ordered time x family """
-        income = income_df.to_numpy()
-        min_income = income.min(axis=1).reshape((income.shape[0], 1))
-        min_income[min_income > 0] = 0
-        positive_income = income - min_income # boost everyone's income in case of negative income
-        total_income = positive_income.sum(axis=1).reshape((income.shape[0], 1))
-        _lorenz = np.sort(positive_income, axis=1).cumsum(axis=1)
-        lorenz = np.true_divide(_lorenz, total_income, out=np.zeros_like(_lorenz), where=total_income>0)
-        return .5 - lorenz.mean(axis=1) # unit triangle - integral of lorenz
+    def gini(cls, income_df: DataFrame, bins=0):
+        """ income is ordered time x family, or trial x time x family """
+        return inequality.gini(np.asarray(income_df), bins)
 
     def add(self, result: SimResultData):
-        self.data = pd.concat([self.data, 
-                        pd.Series(result.data.mean(axis=1), name=f"mean_{self.ntrials}"), 
-                        pd.Series(result.data.std(axis=1), name=f"sd_{self.ntrials}")],
-                        axis=1)
-        if self.name in ["Income", "Capital"]:
-            self.data = pd.concat([self.data, 
-                            pd.Series(SimResultAggData.gini(result.data), name=f"gini_{self.ntrials}")],
-                        axis=1)
-        self.ntrials += 1
+        self.add_summary(summarize(result.values[np.newaxis], self.stats, self.gini_bins))
         if self.keep_trials:
             self.trial_data.append(result)
 
+    def add_batch(self, values: ndarray):
+        """ values is ordered trial x time x family """
+        self.add_summary(summarize(values, self.stats, self.gini_bins))
+        if self.keep_trials:
+            self.trial_data.extend(SimResultData(trial, self.name) for trial in values)
+
+    def add_summary(self, summary: ndarray):
+        """ summary is ordered trial x time x stat, as made by summarize() """
+        ntrials, ntimesteps, width = summary.shape
+        # trial-major columns, the same order as data
+        block = summary.transpose(1, 0, 2).reshape(ntimesteps, ntrials * width)
+        needed = (self.ntrials + ntrials) * width
+        if self._columns is None:
+            self._columns = np.empty((ntimesteps, needed))
+            self.moments = RunningMoments(ntimesteps)
+        elif self._columns.shape[1] < needed:
+            grown = np.empty((ntimesteps, max(needed, 2 * self._columns.shape[1])))
+            grown[:, :self._columns.shape[1]] = self._columns
+            self._columns = grown
+        self._columns[:, self.ntrials * width : needed] = block
+        self.moments.add(block)
+        self._data = None
+        self.ntrials += ntrials
+
+    @property
+    def columns(self) -> ndarray:
+        """ per-trial summaries as a time x (trial, stat) array, in the same order as data """
+        if self._columns is None:
+            return np.empty((0, 0))
+        return self._columns[:, :self.ntrials * len(self.stats)]
+
+    @property
+    def data(self) -> DataFrame:
+        if self._data is None:
+            pd = _pandas()
+            names = [f"{stat}_{trial}" for trial in range(self.ntrials) for stat in self.stats]
+            self._data = pd.DataFrame(self.columns, columns=names)
+        return self._data
+
     def plot(self):
         if self.ntrials == 0:
             print("Error: Nothing to plot")
             return
+        pd, sns = _pandas(), _seaborn()
         self.data.index.rename('Time', inplace=True)
         pdata = self.data.reset_index().melt(id_vars='Time')
         pdata = pd.concat([pdata.Time, pdata.variable.str.split("_", expand=True, n=1), pdata.value], axis=1)
@@ -77,43 +176,122 @@ class SimResultAggData():
 
 
 class SimResultAgg():
-    def __init__(self, keep_trials=False):
+    SUMMARIES = ["income", "neighborhood_size", "human_capital", "mobility"]
+
+    def __init__(self, keep_trials=False, gini_bins=0):
         self.ntrials = 0
-        self.income = SimResultAggData("Income", keep_trials)
-        self.neighborhood_size = SimResultAggData("Neighborhood Size", keep_trials)
-        self.human_capital = SimResultAggData("Capital", keep_trials)
+        self.income = SimResultAggData("Income", keep_trials, gini_bins)
+        self.neighborhood_size = SimResultAggData("Neighborhood Size", keep_trials, gini_bins)
+        self.human_capital = SimResultAggData("Capital", keep_trials, gini_bins)
+        self.mobility = SimResultAggData("Mobility") # only filled by a MobilityRecorder
+        self.transitions = None # time x quantile x quantile family counts, summed over trials
+        self.status = [] # TrialStatus of each trial
+        self.stop_step = [] # timestep each trial stopped at, N_TIMESTEPS if it ran to the end
     
     def add(self, result: SimResult):
         self.income.add(result.income)
         self.neighborhood_size.add(result.neighborhood_size)
         self.human_capital.add(result.human_capital)
+        self.add_status([result.status.value], [result.stop_step])
+
+    def add_status(self, status: ndarray, stop_step: ndarray):
+        """ status holds TrialStatus values, one per trial """
+        self.status.extend(TrialStatus(s) for s in status)
+        self.stop_step.extend(int(s) for s in stop_step)
+        self.ntrials = len(self.status)
+
+    def add_transitions(self, counts: ndarray):
+        self.transitions = counts if self.transitions is None else self.transitions + counts
+
+    def transition_matrix(self) -> ndarray:
+        """ chance of moving from each parent quantile (row) to each child quantile, per timestep """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.transitions / self.transitions.sum(axis=-1, keepdims=True)
+
+    def add_batch(self, income: ndarray, population: ndarray, human_capital: ndarray):
+        """ every array is ordered trial x time x family """
+        self.income.add_batch(income)
+        self.neighborhood_size.add_batch(population)
+        self.human_capital.add_batch(human_capital)
+
+    def to_arrays(self) -> dict:
+        """ the per-trial summaries and statuses as plain arrays, e.g. for np.savez.
+            kept trials are left behind """
+        arrays = {name: getattr(self, name).columns for name in SimResultAgg.SUMMARIES}
+        for name in SimResultAgg.SUMMARIES:
+            moments = getattr(self, name).moments
+            if moments is not None:
+                # merged in the order the trials came, which one block of them would not repeat
+                arrays[f"{name}_moments"] = np.stack([moments.count, moments.mean, moments.m2])
+        arrays["status"] = np.array([s.value for s in self.status], dtype=int)
+        arrays["stop_step"] = np.array(self.stop_step, dtype=int)
+        if self.transitions is not None:
+            arrays["transitions"] = self.transitions
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, gini_bins=0) -> SimResultAgg:
+        result = SimResultAgg(gini_bins=gini_bins)
+        for name in SimResultAgg.SUMMARIES:
+            data, columns = getattr(result, name), arrays[name]
+            if columns.size:
+                ntrials = columns.shape[1] // len(data.stats)
+                data.add_summary(columns.reshape(columns.shape[0], ntrials, len(data.stats)).transpose(1, 0, 2))
+            if f"{name}_moments" in arrays:
+                data.moments.count, data.moments.mean, data.moments.m2 = (np.array(row) for row in
+                                                                          arrays[f"{name}_moments"])
+        if "transitions" in arrays:
+            result.add_transitions(arrays["transitions"])
+        result.add_status(arrays["status"], arrays["stop_step"])
+        return result
 
 
 class SimResultSweepData():
     def __init__(self, name: str):
-        self.data = pd.DataFrame()
         self.name = name
+        self.params = []
+        self.blocks = []
+        self._data = None
 
     def add(self, result: SimResultAggData, param_val: float):
-        param_idx = pd.Index([param_val]).repeat(result.data.shape[0])
-        tuples = list(zip(param_idx, np.arange(result.data.shape[0])))
-        new_idx = pd.MultiIndex.from_tuples(tuples, names=["Param", "Time"])
-        result_data = pd.concat([pd.Series(result.data.mean(axis=1), name=f"mean"), 
-                                pd.Series(result.data.std(axis=1), name=f"sd")],
-                                axis=1)  
-        if self.name in ["Income", "Capital"]:
-            result_data = pd.concat([result_data,
-                            pd.Series(SimResultAggData.gini(result.data), name=f"gini")],
-                            axis=1)
-        result_data.set_index(new_idx, inplace=True)
-        self.data = pd.concat([self.data, result_data], axis=0)
+        if self.name == "Mobility":
+            # each measure averaged over the trials
+            columns = result.columns.reshape(result.columns.shape[0], result.ntrials, len(result.stats))
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                block = np.nanmean(columns, axis=1)
+        else:
+            # moments span every summary column of the agg, as its data frame would
+            block = [result.moments.mean, result.moments.std()]
+            if self.name in ["Income", "Capital"]:
+                block.append(SimResultAggData.gini(result.columns, result.gini_bins))
+            block = np.stack(block, axis=1)
+        self.params.append(param_val)
+        self.blocks.append(block)
+        self._data = None
+
+    @property
+    def data(self) -> DataFrame:
+        if self._data is None:
+            pd = _pandas()
+            if not self.blocks:
+                return pd.DataFrame()
+            ntimesteps = [block.shape[0] for block in self.blocks]
+            # params may be tuples from a multi-parameter grid, np.repeat would split them
+            params = [param for param, n in zip(self.params, ntimesteps) for _ in range(n)]
+            new_idx = pd.MultiIndex.from_arrays([params,
+                                                np.concatenate([np.arange(n) for n in ntimesteps])],
+                                                names=["Param", "Time"])
+            cols = stats_for(self.name)
+            self._data = pd.DataFrame(np.concatenate(self.blocks), index=new_idx, columns=cols)
+        return self._data
     
     def plot(self):
         if self.data.empty:
             print("Error: Nothing to plot")
             return
         pdata = self.data.reset_index().melt(id_vars=['Param','Time'],var_name='Agg')
-        rplt = sns.relplot(data=pdata, x='Time', y='value', col='Agg', hue='Param',
+        rplt = _seaborn().relplot(data=pdata, x='Time', y='value', col='Agg', hue='Param',
                     kind='line', facet_kws={'sharey':False}) \
                 .set_titles(col_template="{col_name}")
         rplt.fig.subplots_adjust(top=0.9)
@@ -125,8 +303,12 @@ class SimResultSweep():
         self.income = SimResultSweepData("Income")
         self.neighborhood_size = SimResultSweepData("Neighborhood Size")
         self.human_capital = SimResultSweepData("Capital")
+        self.mobility = SimResultSweepData("Mobility") # values run with a MobilityRecorder
+        self.ntrials = [] # trials behind each value
     
     def add(self, result: SimResultAgg, param_val: float):
-        self.income.add(result.income, param_val)
-        self.neighborhood_size.add(result.neighborhood_size, param_val)
-        self.human_capital.add(result.human_capital, param_val)
+        self.ntrials.append(result.ntrials)
+        for name in SimResultAgg.SUMMARIES:
+            # summaries nothing filled in, e.g. mobility without its recorder, are left out
+            if getattr(result, name).moments is not None:
+                getattr(self, name).add(getattr(result, name), param_val)
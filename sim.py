@@ -4,11 +4,18 @@
 #   Great Gatsby Curve"
 
 from results import SimResult, SimResultAgg, SimResultSweep
-from income import Income
-from config import Config, Globals, HoodFormation
-from human_capital import HumanCapital
-from neighborhood import StaticNeighborhood, SortedPairsNeighborhood, SortedNeighborhood
+from recorder import Recorder
+from profiler import Profiler
+from config import Config, Globals, TrialStatus
+from stopping import EarlyStopping
+from pool import MechanismPool
+from checkpoint import Checkpoint
+from noise import NoiseBank
+from budget import TrialBudget
+from cache import ResultCache, canonical_hash
+from numpy.random import SeedSequence, default_rng
 import numpy as np
+import copy
 
 # TODO: Set a baseline consumption of 1 unit of income. Their preferences kick in above this threshold. 
 #       People die if they can't meet this consumption. This sets a natural scale on the income units and is
@@ -21,61 +28,330 @@ class Sim():
         self.income = None
         self.capital = None
         self.neighborhood = None
+        self.pool = MechanismPool()
+        self.profiler = None
 
 
     def set(self, param: str, value: float):
         self.config.set(param, value)
 
 
-    def _allocate(self):
+    def _allocate(self, ntrials=1, window=None, first_trial=0):
         """ Depends on config which is modifiable by set() so don't call this during __init__()!"""
-        if not self.income:
-            self.income = Income(self.config, self.globals)
-        if not self.capital:
-            self.capital = HumanCapital(self.config, self.globals)
-        if not self.neighborhood:
-            switch = {
-            HoodFormation.STATIC : StaticNeighborhood(self.config, self.globals),
-            HoodFormation.PERFECT_SORTING_PAIRS : SortedPairsNeighborhood(self.config, self.globals),
-            HoodFormation.PERFECT_SORTING : SortedNeighborhood(self.config, self.globals)
-            }        
-            self.neighborhood = switch.get(self.config.HOOD_FORMATION, StaticNeighborhood(self.config, self.globals))
-
-
-    def _run_trial(self) -> SimResult:
-        self._allocate()
+        self.globals.ntrials = ntrials
+        self.globals.window = window
+        self.globals.first_trial = first_trial
+        self.globals.live = None
+        self.globals.noise = NoiseBank(self.globals.seed) if self.config.COMMON_NOISE else None
+        # reallocates only when the size, formation or dtype changed
+        self.income, self.capital, self.neighborhood = self.pool.acquire(self.config, self.globals)
+
+
+    def _phase(self, name: str, fn, *args):
+        if self.profiler is None:
+            return fn(*args)
+        return self.profiler.measure(name, self.globals.t, fn, *args)
+
+
+    def _record(self, recorder: Recorder):
+        if recorder is not None:
+            slot = self.income.slot()
+            self._phase('record', recorder.record, self.globals.t, self.income.income[slot],
+                        self.neighborhood.hood[slot], self.neighborhood.pop[slot], self.capital.capital[slot])
+
+
+    def _stop_trials(self):
+        """ freezes trials that stopped before this timestep, then checks the rest """
+        t = self.globals.t
+        now, prev = self.income.slot(), self.income.slot(1)
+        frozen = self.stopping.frozen(t)
+        if frozen.any():
+            for state in (self.income.income, self.capital.capital, self.neighborhood.hood, self.neighborhood.pop):
+                state[now, frozen] = state[prev, frozen]
+            dead = self.stopping.dead(t)
+            self.income.income[now, dead] = np.nan
+            self.capital.capital[now, dead] = np.nan
+        if t == 0:
+            self.stopping.check(t, self.income.income[now], self.capital.capital[now])
+        else:
+            self.stopping.check(t, self.income.income[now], self.capital.capital[now],
+                                self.income.income[prev], self.capital.capital[prev])
+        self.globals.live = self.stopping.live(t)
+
+
+    def _start(self, recorder: Recorder = None):
+        """ initializes the allocated batch and simulates the first child generation """
+        self.stopping = EarlyStopping(self.config, self.globals.ntrials)
         self.globals.t = 0
+        self.globals.live = None
         # Initialize an adult generation
         self.income.initialize_income()
         self.capital.initialize_human_capital()
         self.neighborhood.initialize_neighborhoods()
         # Simulate the first child generation
-        taxbase = self.neighborhood.collect_taxes(self.income)
-        self.capital.develop_human_capital(self.income, self.neighborhood, taxbase)
-        
-        for t in range(1, self.config.N_TIMESTEPS):
+        taxbase = self._phase('collect_taxes', self.neighborhood.collect_taxes, self.income)
+        self._phase('develop_human_capital', self.capital.develop_human_capital,
+                    self.income, self.neighborhood, taxbase)
+        if self.config.EARLY_STOP:
+            self._phase('stop_trials', self._stop_trials)
+        self._record(recorder)
+
+
+    def _advance(self, until: int, recorder: Recorder = None):
+        """ steps every trial of the batch on from the current timestep up to `until` """
+        for t in range(self.globals.t + 1, until):
             self.globals.t = t
             # Adult things
-            self.income.gain_income(self.capital.earn_income())
-            self.neighborhood.pick_neighborhood(self.income)
-            taxbase = self.neighborhood.collect_taxes(self.income)
+            earned_income = self._phase('earn_income', self.capital.earn_income)
+            self._phase('gain_income', self.income.gain_income, earned_income)
+            self._phase('pick_neighborhood', self.neighborhood.pick_neighborhood, self.income)
+            taxbase = self._phase('collect_taxes', self.neighborhood.collect_taxes, self.income)
             # Child things
-            self.capital.develop_human_capital(self.income, self.neighborhood, taxbase)
-        
-        return SimResult(self.income.income, self.neighborhood.hood,
-            self.neighborhood.pop, self.capital.capital)
+            self._phase('develop_human_capital', self.capital.develop_human_capital,
+                        self.income, self.neighborhood, taxbase)
+            if self.config.EARLY_STOP:
+                self._phase('stop_trials', self._stop_trials)
+            self._record(recorder)
+            if self.config.EARLY_STOP and self.stopping.finished(t):
+                # every trial has stopped, just fill in the remaining timesteps
+                for t in range(t + 1, until):
+                    self.globals.t = t
+                    self._stop_trials()
+                    self._record(recorder)
+                break
+
+
+    def _simulate(self, recorder: Recorder = None):
+        """ steps every trial of the allocated batch through all timesteps """
+        self._start(recorder)
+        self._advance(self.config.N_TIMESTEPS, recorder)
+
+
+    def _collect(self, trial: int) -> SimResult:
+        # copies, the next trial reuses the state arrays
+        result = SimResult(self.income.income[:, trial].copy(), self.neighborhood.hood[:, trial].copy(),
+            self.neighborhood.pop[:, trial].copy(), self.capital.capital[:, trial].copy())
+        result.status = TrialStatus(self.stopping.status[trial])
+        result.stop_step = int(self.stopping.stop_step[trial])
+        return result
+
+
+    def _run_trial(self, trial=0) -> SimResult:
+        self._allocate(first_trial=trial)
+        self._simulate()
+        return self._collect(0)
+
+
+    def _run_batch(self, ntrials: int, first_trial=0) -> tuple:
+        """ advances all trials together, one vectorized call per phase per timestep.
+            returns income, population and capital ordered trial x time x family """
+        self._allocate(ntrials, first_trial=first_trial)
+        self._simulate()
+        return self._batch_states()
+
+
+    def _batch_states(self) -> tuple:
+        return tuple(np.moveaxis(state, 1, 0).copy() for state in
+                     (self.income.income, self.neighborhood.pop, self.capital.capital))
+
+
+    def _run_recorded(self, ntrials: int, recorder: Recorder, result: SimResultAgg, first_trial=0):
+        """ the mechanisms keep a rolling window of two timesteps, history goes to the recorder """
+        self._allocate(ntrials, window=2, first_trial=first_trial)
+        recorder.start(self.config, ntrials)
+        self._simulate(recorder)
+        # statuses go in first so a recorder can save them with its batch
+        result.add_status(self.stopping.status, self.stopping.stop_step)
+        recorder.collect(result)
+
 
+    def _run_trials(self, result: SimResultAgg, ntrials: int, batched=False, recorder: Recorder = None):
+        """ adds ntrials more trials to result, numbered on from the ones it holds """
+        first_trial = result.ntrials
+        if recorder is not None:
+            recorder.begin(self.config, ntrials)
+            for first in ([first_trial] if batched else range(first_trial, first_trial + ntrials)):
+                self._run_recorded(ntrials if batched else 1, recorder, result, first)
+            recorder.end()
+        elif batched:
+            result.add_batch(*self._run_batch(ntrials, first_trial))
+            result.add_status(self.stopping.status, self.stopping.stop_step)
+        else:
+            for trial in range(first_trial, first_trial + ntrials):
+                result.add(self._run_trial(trial))
 
-    def run(self, ntrials=1, keep_trials=False) -> SimResultAgg:
-        result = SimResultAgg(keep_trials)
-        for trial in range(ntrials):
-            result.add(self._run_trial())
+
+    def run(self, ntrials=1, keep_trials=False, batched=False, recorder: Recorder = None,
+            budget: TrialBudget = None) -> SimResultAgg:
+        """ a budget replaces ntrials, trials then run in batches until its outputs are precise enough """
+        result = SimResultAgg(keep_trials, self.config.GINI_BINS)
+        if budget is None:
+            self._run_trials(result, ntrials, batched, recorder)
+            return result
+        moments = budget.start()
+        while not budget.done(moments, result.ntrials):
+            first_trial = result.ntrials
+            self._run_trials(result, budget.next_batch(first_trial), batched, recorder)
+            moments.add(budget.values(result, first_trial))
+        return result
+
+
+    def checkpoint(self) -> Checkpoint:
+        """ snapshot of the batch as it stands after timestep globals.t """
+        return Checkpoint.capture(self)
+
+
+    def restore(self, checkpoint: Checkpoint):
+        """ puts the sim back to the checkpoint, config and random stream included """
+        self.config = copy.copy(checkpoint.config)
+        # the noise bank made in _allocate is keyed by the checkpoint's seed, not this sim's
+        self.globals.seed = checkpoint.seed
+        self._allocate(checkpoint.ntrials, checkpoint.window, checkpoint.first_trial)
+        self.globals.t = checkpoint.t
+        self.globals.rng.bit_generator.state = copy.deepcopy(checkpoint.rng_state)
+        states = {"income": self.income.income, "noise": self.income.noise, "capital": self.capital.capital,
+                  "hood": self.neighborhood.hood, "pop": self.neighborhood.pop}
+        for name, state in states.items():
+            state[...] = checkpoint.states[name]
+        self.stopping = EarlyStopping(self.config, checkpoint.ntrials)
+        self.stopping.status[:] = checkpoint.status
+        self.stopping.stop_step[:] = checkpoint.stop_step
+        self.globals.live = self.stopping.live(checkpoint.t)
+
+
+    def burn_in(self, until: int, ntrials=1) -> Checkpoint:
+        """ runs a batch through timesteps 0..until-1 and checkpoints it """
+        self._allocate(ntrials)
+        self._start()
+        self._advance(until)
+        return self.checkpoint()
+
+
+    def resume(self, checkpoint: Checkpoint = None, keep_trials=False) -> SimResultAgg:
+        """ finishes the batch from a checkpoint, or from wherever it was left.
+            the result covers every timestep, burn-in included """
+        if checkpoint is not None:
+            self.restore(checkpoint)
+        self._advance(self.config.N_TIMESTEPS)
+        result = SimResultAgg(keep_trials, self.config.GINI_BINS)
+        result.add_batch(*self._batch_states())
+        result.add_status(self.stopping.status, self.stopping.stop_step)
         return result
 
 
-    def run_sweep(self, param: str, values: list, ntrials=1) -> SimResultSweep:
+    def fork(self, param: str, values: list, at: int, ntrials=1, keep_trials=False) -> SimResultSweep:
+        """ burns in once up to timestep `at` under the current config, then branches
+            each value of param from the same state and the same random stream """
+        checkpoint = self.burn_in(at, ntrials)
+        key = MechanismPool.key(self.config, self.globals)
         result = SimResultSweep()
         for value in values:
+            self.restore(checkpoint)
             self.config.set(param, value)
-            result.add(self.run(ntrials), value)
+            if MechanismPool.key(self.config, self.globals) != key:
+                print(f"Error: Can't fork on {param}, it changes the shape of the state")
+                break
+            result.add(self.resume(keep_trials=keep_trials), value)
+        self.config = checkpoint.config
+        return result
+
+
+    def run_sweep(self, param: str, values: list, ntrials=1, batched=False, workers=None,
+                  recorder: Recorder = None, budget: TrialBudget = None) -> SimResultSweep:
+        """ workers=None runs in this process on the shared random stream. Any worker
+            count seeds each (value, trial) on its own and gives identical results.
+            A budget picks the trial count of each value separately. Budgets,
+            recorders and batching only run in this process. """
+        if workers is not None and budget is not None:
+            print("Error: Adaptive trial counts only run in this process, ignoring workers")
+            workers = None
+        if workers is not None and recorder is not None:
+            # each worker would watch its own copy of the recorder
+            print("Error: Recorders only run in this process, ignoring workers")
+            workers = None
+        if workers is not None and batched:
+            print("Error: Workers run one trial per task, ignoring workers for the batched sweep")
+            workers = None
+        if workers is not None:
+            return self._run_sweep_parallel(param, values, ntrials, workers)
+        result = SimResultSweep()
+        base = self.config
+        try:
+            for value in values:
+                # each value runs on its own copy so the sim's config is left as it was
+                self.config = copy.copy(base)
+                self.config.set(param, value)
+                result.add(self.run(ntrials, batched=batched, recorder=recorder, budget=budget), value)
+        finally:
+            self.config = base
+        return result
+
+
+    def run_grid(self, points: list, ntrials=1, batched=False, cache: ResultCache = None,
+                 recorder: Recorder = None) -> SimResultSweep:
+        """ points are dicts of config fields, e.g. from design.full_factorial or
+            design.latin_hypercube. each point runs on a stream seeded by its config,
+            so it doesn't depend on the rest of the grid and a cache can hand it back.
+            params of the sweep are tuples of the point's values in order """
+        result = SimResultSweep()
+        base, rng = self.config, self.globals.rng
+        # cached results are only reused by runs with the same recorders
+        recorded = None if recorder is None else \
+            "+".join(type(each).__name__ for each in getattr(recorder, "recorders", [recorder]))
+        try:
+            for point in points:
+                self.config = copy.copy(base)
+                for param, value in point.items():
+                    self.config.set(param, value)
+                agg = cache.get(self.config, self.globals.seed, ntrials, batched, recorded) if cache is not None else None
+                if agg is None:
+                    digest = canonical_hash(self.config, self.globals.seed)
+                    self.globals.rng = default_rng(SeedSequence([self.globals.seed, int(digest[:32], 16)]))
+                    agg = self.run(ntrials, batched=batched, recorder=recorder)
+                    if cache is not None:
+                        cache.put(self.config, self.globals.seed, ntrials, batched, agg, recorded)
+                values = tuple(point.values())
+                result.add(agg, values[0] if len(values) == 1 else values)
+        finally:
+            self.config, self.globals.rng = base, rng
         return result
+
+
+    def _run_sweep_parallel(self, param: str, values: list, ntrials: int, workers: int) -> SimResultSweep:
+        # a fresh root each call so reruns spawn the same children
+        seeds = SeedSequence(self.globals.seed).spawn(len(values) * ntrials)
+        profile = self.profiler is not None
+        tasks = [(self.config, param, value, seeds[i * ntrials + trial], profile, trial, self.globals.seed)
+                 for i, value in enumerate(values) for trial in range(ntrials)]
+        if workers == 1:
+            trials = [_sweep_task(*task) for task in tasks]
+        else:
+            # the process machinery is only imported by runs that use it
+            from concurrent.futures import ProcessPoolExecutor
+            chunksize = max(1, len(tasks) // (4 * workers))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                trials = list(pool.map(_sweep_task, *zip(*tasks), chunksize=chunksize))
+        result = SimResultSweep()
+        for i, value in enumerate(values):
+            agg = SimResultAgg(gini_bins=self.config.GINI_BINS)
+            for trial_result, stats in trials[i * ntrials : (i + 1) * ntrials]:
+                agg.add(trial_result)
+                if profile:
+                    self.profiler.merge(stats)
+            result.add(agg, value)
+        return result
+
+
+def _sweep_task(config: Config, param: str, value: float, seed: SeedSequence, profile=False,
+                trial=0, root_seed=12345) -> tuple:
+    """ one (value, trial) of a parallel sweep. lives at module level so the pool can pickle it.
+        returns the trial and, when profiling, the worker's phase stats """
+    sim = Sim()
+    sim.config = copy.copy(config)
+    sim.config.set(param, value)
+    # the noise bank, if any, is keyed by the sweep's seed and the trial number
+    sim.globals = Globals(root_seed)
+    sim.globals.rng = default_rng(seed)
+    if profile:
+        sim.profiler = Profiler()
+    return sim._run_trial(trial), sim.profiler.stats if profile else None
@@ -0,0 +1,60 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Early stopping of trials that blow up or settle down
+
+from config import Config, TrialStatus
+import numpy as np
+from numpy import ndarray
+
+
+class EarlyStopping():
+    """ Vectorized per-trial checks after every timestep. Once a trial stops, the sim
+        freezes it: converged trials repeat their steady state and dead trials go NaN. """
+    def __init__(self, config: Config, ntrials: int):
+        self.config = config
+        self.status = np.full(ntrials, TrialStatus.COMPLETED.value)
+        self.stop_step = np.full(ntrials, config.N_TIMESTEPS)
+
+    @classmethod
+    def _relative_change(cls, now: ndarray, prev: ndarray) -> ndarray:
+        with np.errstate(invalid='ignore', over='ignore'):
+            scale = np.maximum(np.abs(prev).max(axis=1), np.finfo(float).tiny)
+            return np.abs(now - prev).max(axis=1) / scale
+
+    def check(self, t: int, income: ndarray, capital: ndarray, prev_income=None, prev_capital=None):
+        """ states are ordered trial x family. the prev ones are missing at t=0 """
+        running = self.stop_step > t
+        nonfinite = ~(np.isfinite(income).all(axis=1) & np.isfinite(capital).all(axis=1))
+        with np.errstate(invalid='ignore'):
+            explosive = ((np.abs(income).max(axis=1) > self.config.DIVERGENCE_LIMIT) |
+                         (np.abs(capital).max(axis=1) > self.config.DIVERGENCE_LIMIT))
+        converged = np.zeros_like(running)
+        if prev_income is not None:
+            if self.config.GROWTH_LIMIT:
+                with np.errstate(invalid='ignore', over='ignore'):
+                    explosive |= (np.abs(income).mean(axis=1) >
+                                  self.config.GROWTH_LIMIT * np.abs(prev_income).mean(axis=1))
+            converged = ((EarlyStopping._relative_change(income, prev_income) <= self.config.CONVERGENCE_TOL) &
+                         (EarlyStopping._relative_change(capital, prev_capital) <= self.config.CONVERGENCE_TOL))
+        # the first reason found wins
+        for status, hit in [(TrialStatus.NONFINITE, nonfinite), (TrialStatus.EXPLOSIVE, explosive),
+                            (TrialStatus.CONVERGED, converged)]:
+            stopping = running & hit
+            self.status[stopping] = status.value
+            self.stop_step[stopping] = t
+            running &= ~stopping
+
+    def frozen(self, t: int) -> ndarray:
+        """ trials that stopped before timestep t """
+        return self.stop_step < t
+
+    def dead(self, t: int) -> ndarray:
+        """ frozen trials whose state is not worth carrying forward """
+        return self.frozen(t) & (self.status != TrialStatus.CONVERGED.value)
+
+    def live(self, t: int) -> ndarray:
+        """ rows still running after timestep t, or None when none have stopped """
+        running = self.stop_step > t
+        return None if running.all() else np.flatnonzero(running)
+
+    def finished(self, t: int) -> bool:
+        return bool((self.stop_step <= t).all())
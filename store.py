@@ -0,0 +1,126 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: On-disk result store of memory-mapped .npy chunks
+
+from config import Config, TrialStatus
+from recorder import Recorder
+from results import SimResultAgg, SimResultSweep
+import numpy as np
+from numpy import ndarray
+import json
+import os
+
+
+class ResultStore():
+    """ A directory of .npy chunks plus an index.json describing them. Each chunk
+        holds one batch of trials ordered time x trial x family, and remembers the
+        config it ran under so results can be regrouped when opened, along with how
+        each of its trials ended. """
+    STATES = {"income": None, "hood": np.int32, "pop": np.int32, "capital": None} # None is Config.FLOAT_DTYPE
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index_file = os.path.join(path, "index.json")
+        self.chunks = []
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.chunks = json.load(f)["chunks"]
+
+    @classmethod
+    def _describe(cls, config: Config) -> dict:
+        return config.describe()
+
+    def new_chunk(self, config: Config, ntrials: int) -> dict:
+        """ reserves a chunk on disk and returns its writable memmaps """
+        chunk = {"id": len(self.chunks), "ntrials": ntrials, "config": ResultStore._describe(config)}
+        shape = (config.N_TIMESTEPS, ntrials, config.N_FAMILIES)
+        arrays = {name: np.lib.format.open_memmap(self._file(chunk, name), mode="w+", shape=shape,
+                                                  dtype=dtype or config.FLOAT_DTYPE)
+                  for name, dtype in ResultStore.STATES.items()}
+        self.chunks.append(chunk)
+        return arrays
+
+    def flush(self):
+        with open(self.index_file, "w") as f:
+            json.dump({"chunks": self.chunks}, f)
+
+    def _file(self, chunk: dict, name: str) -> str:
+        return os.path.join(self.path, f"chunk_{chunk['id']}_{name}.npy")
+
+    def load(self, chunk: dict, name: str) -> ndarray:
+        """ read-only memmap of one state, nothing is read until it is indexed """
+        return np.load(self._file(chunk, name), mmap_mode="r")
+
+    def select(self, **fields) -> list:
+        """ chunks whose config matches every given field """
+        return [c for c in self.chunks if all(c["config"].get(k) == v for k, v in fields.items())]
+
+    def open_agg(self, keep_trials=True, **fields) -> SimResultAgg:
+        """ aggregates the matching chunks. kept trials are views into the memmaps """
+        chunks = self.select(**fields)
+        result = SimResultAgg(keep_trials, chunks[0]["config"]["GINI_BINS"] if chunks else 0)
+        for chunk in chunks:
+            result.add_batch(*(np.moveaxis(self.load(chunk, name), 1, 0) for name in ["income", "pop", "capital"]))
+            # chunks written without a recorder ran every trial to the end
+            ntrials, ntimesteps = chunk["ntrials"], chunk["config"]["N_TIMESTEPS"]
+            result.add_status(chunk.get("status", [TrialStatus.COMPLETED.value] * ntrials),
+                              chunk.get("stop_step", [ntimesteps] * ntrials))
+        return result
+
+    def open_sweep(self, param: str, keep_trials=False) -> SimResultSweep:
+        result = SimResultSweep()
+        values = []
+        for chunk in self.chunks:
+            if chunk["config"][param] not in values:
+                values.append(chunk["config"][param])
+        for value in values:
+            result.add(self.open_agg(keep_trials, **{param: value}), value)
+        return result
+
+
+class StoreRecorder(Recorder):
+    """ streams every timestep of every trial straight into a ResultStore, one chunk
+        per run. the index is written once the run is over """
+    def __init__(self, store: ResultStore):
+        self.store = store
+        self.arrays = None
+        self.chunk = None
+        self.batch = None
+        self.filled = 0
+
+    def begin(self, config: Config, ntrials: int):
+        self.arrays = self.store.new_chunk(config, ntrials)
+        self.chunk = self.store.chunks[-1]
+        self.chunk["status"], self.chunk["stop_step"] = [], []
+        self.filled = 0
+
+    def start(self, config: Config, ntrials: int):
+        if self.arrays is None:
+            # driven batch by batch without a run around it
+            self.begin(config, ntrials)
+        self.batch = slice(self.filled, self.filled + ntrials)
+
+    def record(self, t: int, income: ndarray, hood: ndarray, pop: ndarray, capital: ndarray):
+        self.arrays["income"][t, self.batch] = income
+        self.arrays["hood"][t, self.batch] = hood
+        self.arrays["pop"][t, self.batch] = pop
+        self.arrays["capital"][t, self.batch] = capital
+
+    def collect(self, result: SimResultAgg):
+        # the sim has added this batch's statuses last
+        ntrials = self.batch.stop - self.batch.start
+        self.chunk["status"].extend(s.value for s in result.status[-ntrials:])
+        self.chunk["stop_step"].extend(result.stop_step[-ntrials:])
+        self.filled = self.batch.stop
+        result.add_batch(*(np.moveaxis(self.arrays[name][:, self.batch], 1, 0)
+                           for name in ["income", "pop", "capital"]))
+        if self.filled == self.chunk["ntrials"]:
+            self.end()
+
+    def end(self):
+        if self.arrays is None:
+            return
+        for array in self.arrays.values():
+            array.flush()
+        self.store.flush()
+        self.arrays = None
@@ -0,0 +1,60 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Tests of the sorting rule against a family by family version of it
+# Usage: python -m pytest -q test_neighborhood.py
+
+from neighborhood import sorted_neighborhoods
+from mechanism import edu_efficiency
+import numpy as np
+
+
+def greedy_neighborhoods(income: np.ndarray, lower: float, upper: float) -> np.ndarray:
+    """ the sorting rule one family at a time: from the richest down, a family joins
+        the neighborhood above it unless that lowers its total child capital """
+    n = income.size
+    order = np.argsort(-income)
+    ranked = np.maximum(1, income[order])
+    ranked = ranked / ranked[0]
+
+    def capital(members: list) -> float:
+        if len(members) < 2:
+            return 0
+        total = sum(members)
+        # each family's income times the average of its neighbors, funded at D(p)
+        learned = sum(y * (total - y) / (len(members) - 1) for y in members)
+        return total * learned / edu_efficiency(len(members), lower, upper, n)
+
+    labels = np.zeros(n, dtype=np.int32)
+    members = [ranked[0]]
+    for rank in range(1, n):
+        if capital(members + [ranked[rank]]) >= capital(members):
+            members.append(ranked[rank])
+            labels[rank] = labels[rank - 1]
+        else:
+            members = [ranked[rank]]
+            labels[rank] = labels[rank - 1] + 1
+    hood = np.empty(n, dtype=np.int32)
+    hood[order] = labels
+    return hood
+
+
+def test_matches_greedy_rule():
+    rng = np.random.default_rng(0)
+    for n in [2, 3, 7, 50, 300]:
+        income = rng.lognormal(0, rng.uniform(.1, 2, size=(20, 1)), size=(20, n))
+        # ties and incomes under the floor of 1 as well
+        income[::4, : n // 2] = income[::4, :1]
+        income[1::4] *= .5
+        lower, upper = rng.uniform(.1, 1, size=20), rng.uniform(1, 3, size=20)
+        hood = sorted_neighborhoods(income, lower, upper, n)
+        for row in range(20):
+            np.testing.assert_array_equal(hood[row], greedy_neighborhoods(income[row], lower[row], upper[row]))
+
+
+def test_nonfinite_rows_are_one_neighborhood():
+    rng = np.random.default_rng(1)
+    income = rng.lognormal(size=(4, 100))
+    income[1, 3] = np.nan
+    income[2, 7] = np.inf
+    hood = sorted_neighborhoods(income, .5, 2, 100)
+    assert (hood[1] == 0).all() and (hood[2] == 0).all()
+    np.testing.assert_array_equal(hood[[0, 3]], sorted_neighborhoods(income[[0, 3]], .5, 2, 100))
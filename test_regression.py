@@ -0,0 +1,86 @@
+# Author: Eric Chandler <echandler@uchicago.edu>
+# Brief: Regression tests of the engine on a small stable config
+# Usage: python -m pytest -q test_regression.py
+
+from sim import Sim
+from config import Globals
+from checkpoint import Checkpoint
+from cache import ResultCache
+from design import full_factorial
+import numpy as np
+
+# a parameter set that stays finite, small enough to run in well under a second
+STABLE = {
+    "INCOME_GROWTH": 1,
+    "TAX_RATE": .1,
+    "SKILL_FROM_INCOME": .01,
+    "CAPITAL_EFFICIENCY": .5,
+    "INCOME_NOISE_ADDITIVE": .3,
+    "N_FAMILIES": 50,
+    "N_TIMESTEPS": 10,
+}
+
+# last timestep of run(3) from seed 12345, ordered (trial, stat) as in SimResultAggData.columns
+BASELINE_INCOME = [1.2092583631667697, 0.23924391304939002, 0.04485606476000975,
+                   1.1784599693738462, 0.17669836856712606, 0.03246482424637442,
+                   1.1985043580701573, 0.23750925046162907, 0.04534574328706314]
+BASELINE_CAPITAL = [0.00406140329789628, 0.00073112286965283, 0.04003299328117621,
+                    0.00374051253244384, 0.00052287463775971, 0.02935117698714779,
+                    0.00394612123100975, 0.00068985150004509, 0.03751334747073637]
+
+
+def make_sim(**fields) -> Sim:
+    sim = Sim()
+    sim.globals = Globals(12345)
+    for param, value in {**STABLE, **fields}.items():
+        sim.set(param, value)
+    return sim
+
+
+def assert_same(a, b):
+    """ every summary of two SimResultAggs, bit for bit """
+    for name in ["income", "neighborhood_size", "human_capital"]:
+        np.testing.assert_array_equal(getattr(a, name).columns, getattr(b, name).columns)
+    assert a.status == b.status
+    assert a.stop_step == b.stop_step
+
+
+def test_sequential_matches_baseline():
+    result = make_sim().run(3)
+    assert result.ntrials == 3
+    np.testing.assert_allclose(result.income.columns[-1], BASELINE_INCOME, rtol=1e-12)
+    np.testing.assert_allclose(result.human_capital.columns[-1], BASELINE_CAPITAL, rtol=1e-12)
+
+
+def test_batched_matches_sequential_with_common_noise():
+    sequential = make_sim(COMMON_NOISE=True).run(4)
+    batched = make_sim(COMMON_NOISE=True).run(4, batched=True)
+    assert_same(sequential, batched)
+
+
+def test_sweep_is_the_same_for_any_worker_count():
+    values = [.05, .1]
+    one = make_sim().run_sweep("TAX_RATE", values, 2, workers=1)
+    two = make_sim().run_sweep("TAX_RATE", values, 2, workers=2)
+    for name in ["income", "neighborhood_size", "human_capital"]:
+        np.testing.assert_array_equal(getattr(one, name).data.values, getattr(two, name).data.values)
+
+
+def test_resume_from_checkpoint_is_exact(tmp_path):
+    for common_noise in [False, True]:
+        uninterrupted = make_sim(COMMON_NOISE=common_noise).run(3, batched=True)
+        path = str(tmp_path / f"checkpoint_{common_noise}.pkl")
+        make_sim(COMMON_NOISE=common_noise).burn_in(4, 3).save(path)
+        # resumed by a sim on another seed, the checkpoint brings its own
+        resumed = Sim()
+        resumed.globals = Globals(1)
+        assert_same(uninterrupted, resumed.resume(Checkpoint.load(path)))
+
+
+def test_cached_grid_matches_fresh(tmp_path):
+    points = full_factorial({"TAX_RATE": [.05, .1]})
+    cache = ResultCache(str(tmp_path))
+    fresh = make_sim().run_grid(points, 5, cache=cache)
+    cached = make_sim().run_grid(points, 5, cache=cache)
+    for name in ["income", "neighborhood_size", "human_capital"]:
+        np.testing.assert_array_equal(getattr(fresh, name).data.values, getattr(cached, name).data.values)